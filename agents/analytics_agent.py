@@ -1,94 +1,445 @@
 import logging
-from typing import Dict, Any, List
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.oauth2 import service_account
-from google.analytics.data_v1beta.types import RunReportRequest, Metric, Dimension, DateRange, FilterExpression
+import asyncio
+import functools
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+from google.analytics.data_v1beta.types import (
+    RunReportRequest, BatchRunReportsRequest, Metric, Dimension, DateRange,
+    Filter, FilterExpression, FilterExpressionList
+)
 import os
+import orjson
+import pandas as pd
+from utils.auth import get_ga4_client
 from utils.ga4_planner import plan_ga4_query
-from utils.llm_utils import LLMQueryPlanner
+from utils.ga4_schema import ALLOWED_METRICS, ALLOWED_DIMENSIONS, CUSTOM_FIELD_PREFIXES
+from utils.llm_utils import generate_natural_language_response, stream_natural_language_response
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Server-side cap on rows per report, whatever limit the planner asks for
+GA4_MAX_LIMIT = int(os.getenv("GA4_MAX_LIMIT", "10000"))
+
+# The summary LLM only needs a preview of the report, not every row
+SUMMARY_ROW_LIMIT = 50
+
+# Processed GA4 report rows keyed by plan hash -> (stored_at, data)
+REPORT_CACHE_TTL = 300  # seconds
+REPORT_CACHE_MAX_SIZE = 512
+_report_cache: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+
+def _cache_report(key: str, data: List[Dict[str, Any]]) -> None:
+    _report_cache[key] = (time.monotonic(), data)
+    _report_cache.move_to_end(key)
+    if len(_report_cache) > REPORT_CACHE_MAX_SIZE:
+        _report_cache.popitem(last=False)
+
+def _cached_report(key: str) -> Optional[List[Dict[str, Any]]]:
+    """Fresh cached rows for key, or None; expired entries are dropped on sight."""
+    cached = _report_cache.get(key)
+    if cached is None:
+        return None
+    if time.monotonic() - cached[0] >= REPORT_CACHE_TTL:
+        del _report_cache[key]
+        return None
+    _report_cache.move_to_end(key)
+    return cached[1]
+
+def _report_cache_key(plan: Dict[str, Any], property_id: str) -> str:
+    payload = orjson.dumps(plan, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS, default=str) + property_id.encode()
+    return hashlib.blake2b(payload).hexdigest()
+
+_DATE_RE = re.compile(r"^(\d{4}-\d{2}-\d{2}|\d+daysAgo|today|yesterday)$")
+
+def _unknown_fields(names: List[Any], allowed: frozenset) -> List[Any]:
+    # Common case: every name is a known field, a single C-level subset check
+    if allowed.issuperset(names):
+        return []
+    return [n for n in names if n not in allowed and not str(n).startswith(CUSTOM_FIELD_PREFIXES)]
+
+def _validate_plan(plan: Dict[str, Any]) -> Optional[str]:
+    """Cheap sanity checks on a plan; returns an error message or None if it is runnable."""
+    metrics = plan.get("metrics") or []
+    if not metrics:
+        return "the plan has no metrics"
+    unknown = _unknown_fields(metrics, ALLOWED_METRICS)
+    if unknown:
+        return f"unknown metrics: {', '.join(map(str, unknown))}"
+    unknown = _unknown_fields(plan.get("dimensions") or [], ALLOWED_DIMENSIONS)
+    if unknown:
+        return f"unknown dimensions: {', '.join(map(str, unknown))}"
+    for key in ("start_date", "end_date"):
+        if key in plan and not _DATE_RE.match(str(plan[key])):
+            return f"invalid {key}: {plan[key]}"
+    limit = plan.get("limit")
+    if limit is not None:
+        try:
+            if int(limit) <= 0:
+                return f"invalid limit: {limit}"
+        except (TypeError, ValueError):
+            return f"invalid limit: {limit}"
+    return None
+
+# Plan match_type strings -> GA4 string filter match types
+_MATCH_TYPES = {
+    "EXACT": Filter.StringFilter.MatchType.EXACT,
+    "BEGINS_WITH": Filter.StringFilter.MatchType.BEGINS_WITH,
+    "ENDS_WITH": Filter.StringFilter.MatchType.ENDS_WITH,
+    "CONTAINS": Filter.StringFilter.MatchType.CONTAINS,
+    "FULL_REGEXP": Filter.StringFilter.MatchType.FULL_REGEXP,
+    "PARTIAL_REGEXP": Filter.StringFilter.MatchType.PARTIAL_REGEXP,
+}
+
+# Request pieces that only depend on their inputs; proto-plus copies them into each request
+@functools.lru_cache(maxsize=32)
+def _property_path(property_id: str) -> str:
+    return f"properties/{property_id}"
+
+@functools.lru_cache(maxsize=32)
+def _metric_protos(metrics: Tuple[str, ...]) -> Tuple[Metric, ...]:
+    return tuple(Metric(name=m) for m in metrics)
+
+@functools.lru_cache(maxsize=32)
+def _dimension_protos(dimensions: Tuple[str, ...]) -> Tuple[Dimension, ...]:
+    return tuple(Dimension(name=d) for d in dimensions)
+
+# Reports for the same property submitted within this window share one batchRunReports call
+# (opt-in via SPIKEAI_REPORT_BATCHING=1; otherwise each report is its own runReport)
+REPORT_BATCHING_ENABLED = os.getenv("SPIKEAI_REPORT_BATCHING") == "1"
+BATCH_WINDOW_SECS = 0.02
+BATCH_MAX_SIZE = 5  # GA4 accepts at most 5 requests per batch
+
+# LLM-generated plans keyed by normalized query + property (opt-in via SPIKEAI_PLAN_CACHE=1)
+PLAN_CACHE_ENABLED = os.getenv("SPIKEAI_PLAN_CACHE") == "1"
+PLAN_CACHE_MAX_SIZE = 1024
+PLAN_CACHE_TTL = 300  # seconds a plan is served as fresh
+PLAN_CACHE_STALE_SECS = 300  # after the TTL, served once more while it is re-planned
+# key -> (stored_at, plan)
+_plan_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_plan_refreshes: Dict[str, asyncio.Task] = {}
+
+def _plan_cache_key(query: str, property_id: str) -> str:
+    normalized = re.sub(r"[^\w\s]", "", query.lower())
+    normalized = " ".join(normalized.split())
+    return hashlib.sha1(f"{normalized}|{property_id}".encode()).hexdigest()
+
+def _store_plan(key: str, plan: Dict[str, Any]) -> None:
+    _plan_cache[key] = (time.monotonic(), plan)
+    _plan_cache.move_to_end(key)
+    if len(_plan_cache) > PLAN_CACHE_MAX_SIZE:
+        _plan_cache.popitem(last=False)
+
+async def _refresh_plan(key: str, query: str, property_id: str) -> None:
+    try:
+        _store_plan(key, await plan_ga4_query(query, property_id))
+    except Exception as e:
+        logger.warning("GA4 plan refresh failed: %s", e)
+    finally:
+        _plan_refreshes.pop(key, None)
+
+async def _get_plan(query: str, property_id: str) -> Dict[str, Any]:
+    if not PLAN_CACHE_ENABLED:
+        return await plan_ga4_query(query, property_id)
+
+    key = _plan_cache_key(query, property_id)
+    cached = _plan_cache.get(key)
+    if cached is not None:
+        age = time.monotonic() - cached[0]
+        if age < PLAN_CACHE_TTL + PLAN_CACHE_STALE_SECS:
+            _plan_cache.move_to_end(key)
+            # Past the TTL: answer from the old plan and re-plan in the background
+            if age >= PLAN_CACHE_TTL and key not in _plan_refreshes:
+                _plan_refreshes[key] = asyncio.create_task(_refresh_plan(key, query, property_id))
+            logger.info("GA4 plan cache hit: %s", key[:12])
+            return cached[1]
+
+    plan = await plan_ga4_query(query, property_id)
+    _store_plan(key, plan)
+    return plan
+
 class AnalyticsAgent:
     def __init__(self):
+        # In-flight report fetches keyed by plan hash, shared by concurrent callers
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # Requests waiting for the next batch flush, grouped by property path
+        self._pending: Dict[str, List[Tuple[RunReportRequest, asyncio.Future]]] = {}
+        self._batch_tasks: set = set()
+
+    @functools.cached_property
+    def client(self):
+        """GA4 client, built on first use so importing this module does no I/O."""
         try:
             # 1. Prioritize credentials.json at root (for Evaluators)
             creds_file = "credentials.json"
             
             if os.path.exists(creds_file):
                 logger.info(f"Loading credentials from local {creds_file}")
-                credentials = service_account.Credentials.from_service_account_file(
-                    creds_file,
-                    scopes=['https://www.googleapis.com/auth/analytics.readonly']
-                )
+                credentials_path = creds_file
             else:
                 # 2. Fallback to Env Var
                 credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
                 if not credentials_path:
                     # Don't crash here, just log. Connection will fail later if used.
                     logger.warning("No credentials found. Analytics will fail.")
-                    self.client = None
-                    return
+                    return None
 
-                credentials = service_account.Credentials.from_service_account_file(
-                    credentials_path,
-                    scopes=['https://www.googleapis.com/auth/analytics.readonly']
-                )
-
-            self.client = BetaAnalyticsDataClient(credentials=credentials)
+            client = get_ga4_client(credentials_path)
             logger.info("Successfully initialized GA4 client")
+            return client
             
         except Exception as e:
             logger.error(f"Error initializing GA4 client: {str(e)}")
-            self.client = None
+            return None
     
-    async def run_analytics_query(self, query: str, property_id: str) -> Dict[str, Any]:
+    @staticmethod
+    def _process_ga4_response(response, plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Build report rows column by column, coercing metric columns to numbers in one pass."""
+        rows = response.rows
+        if not rows:
+            return []
+
+        columns: Dict[str, Any] = {}
+        # Dimensions
+        for i, name in enumerate(plan["dimensions"][:len(rows[0].dimension_values)]):
+            columns[name] = [row.dimension_values[i].value for row in rows]
+        # Metrics
+        for i, name in enumerate(plan["metrics"][:len(rows[0].metric_values)]):
+            raw = [row.metric_values[i].value for row in rows]
+            # Counts (activeUsers, sessions, ...) are plain integers: skip the float pass
+            if all(v.lstrip("-").isdigit() for v in raw):
+                columns[name] = [int(v) for v in raw]
+                continue
+            values = pd.to_numeric(pd.Series(raw), errors="coerce")
+            if values.isna().any():
+                columns[name] = raw
+            elif (values % 1 == 0).all():
+                columns[name] = values.astype("int64")
+            else:
+                columns[name] = values
+
+        return pd.DataFrame(columns).to_dict(orient="records")
+
+    @staticmethod
+    def _build_filter_expression(filters: Dict[str, Any], metrics: List[str]) -> Optional[FilterExpression]:
+        """Turn plan filters ({dimension: value} or {dimension: {match_type, value}}) into a dimension filter."""
+        expressions = []
+        for field_name, spec in (filters or {}).items():
+            if field_name in metrics:
+                continue
+            if isinstance(spec, dict):
+                value = spec.get("value")
+                match_type = str(spec.get("match_type", "EXACT"))
+            else:
+                value, match_type = spec, "EXACT"
+            if value is None or value == "":
+                continue
+            expressions.append(FilterExpression(filter=Filter(
+                field_name=field_name,
+                string_filter=Filter.StringFilter(
+                    value=str(value),
+                    match_type=_MATCH_TYPES.get(match_type.upper(), Filter.StringFilter.MatchType.EXACT)
+                )
+            )))
+
+        if not expressions:
+            return None
+        if len(expressions) == 1:
+            return expressions[0]
+        return FilterExpression(and_group=FilterExpressionList(expressions=expressions))
+
+    @staticmethod
+    def _build_ga4_request(plan: Dict[str, Any], property_id: str) -> RunReportRequest:
+        metrics = plan.get("metrics", ["activeUsers"])
+        request = RunReportRequest(
+            property=_property_path(property_id),
+            metrics=list(_metric_protos(tuple(metrics))),
+            dimensions=list(_dimension_protos(tuple(plan.get("dimensions", ["date"])))),
+            date_ranges=[DateRange(
+                start_date=plan.get("start_date", "30daysAgo"), 
+                end_date=plan.get("end_date", "today")
+            )]
+        )
+        limit = int(plan.get("limit", 1000) or 1000)
+        if limit > GA4_MAX_LIMIT:
+            logger.warning("Clamping GA4 limit %s to %s", limit, GA4_MAX_LIMIT)
+            limit = GA4_MAX_LIMIT
+        request.limit = limit
+        dimension_filter = AnalyticsAgent._build_filter_expression(plan.get("filters"), metrics)
+        if dimension_filter is not None:
+            request.dimension_filter = dimension_filter
+        return request
+
+    async def _submit_report(self, request: RunReportRequest):
+        """Queue a request for the next batch of its property and wait for its report."""
+        if not REPORT_BATCHING_ENABLED:
+            # The GA4 client is blocking gRPC, so run it on a worker thread to keep the loop free
+            return await asyncio.to_thread(self.client.run_report, request)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        group = self._pending.setdefault(request.property, [])
+        group.append((request, fut))
+        if len(group) >= BATCH_MAX_SIZE:
+            self._flush_batch(request.property)
+        elif len(group) == 1:
+            loop.call_later(BATCH_WINDOW_SECS, self._flush_batch, request.property)
+        return await fut
+
+    def _flush_batch(self, property_path: str) -> None:
+        batch = self._pending.pop(property_path, None)
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run_batch(property_path, batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, property_path: str, batch: List[Tuple[RunReportRequest, asyncio.Future]]) -> None:
+        # The GA4 client is blocking gRPC, so run it on a worker thread to keep the loop free
+        try:
+            if len(batch) == 1:
+                reports = [await asyncio.to_thread(self.client.run_report, batch[0][0])]
+            else:
+                logger.info("Submitting %d GA4 reports in one batch for %s", len(batch), property_path)
+                response = await asyncio.to_thread(
+                    self.client.batch_run_reports,
+                    BatchRunReportsRequest(property=property_path, requests=[r for r, _ in batch])
+                )
+                reports = list(response.reports)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # One bad request fails the whole batch; rerun each on its own so only it
+            # gets the error and the unrelated requests still get their reports
+            logger.warning("GA4 batch of %d failed (%s); retrying individually", len(batch), e)
+            results = await asyncio.gather(
+                *(asyncio.to_thread(self.client.run_report, request) for request, _ in batch),
+                return_exceptions=True
+            )
+            for (_, fut), result in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(result, BaseException):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+            return
+
+        for i, (_, fut) in enumerate(batch):
+            if fut.done():
+                continue
+            if i < len(reports):
+                fut.set_result(reports[i])
+            else:
+                fut.set_exception(RuntimeError(
+                    f"GA4 batch returned {len(reports)} reports for {len(batch)} requests"
+                ))
+
+    async def _fetch_report(self, plan: Dict[str, Any], property_id: str, cache_key: str) -> List[Dict[str, Any]]:
+        """Run the GA4 report, coalescing concurrent identical requests into one RPC.
+
+        The fetch runs in its own task and every caller, the first included, awaits
+        it through asyncio.shield, so a cancelled caller never cancels the others.
+        """
+        task = self._inflight.get(cache_key)
+        if task is not None:
+            logger.info("Joining in-flight GA4 request: %s", cache_key[:12])
+        else:
+            task = asyncio.get_running_loop().create_task(self._run_fetch(plan, property_id, cache_key))
+            self._inflight[cache_key] = task
+            task.add_done_callback(functools.partial(self._fetch_done, cache_key))
+        return await asyncio.shield(task)
+
+    async def _run_fetch(self, plan: Dict[str, Any], property_id: str, cache_key: str) -> List[Dict[str, Any]]:
+        request = self._build_ga4_request(plan, property_id)
+        response = await self._submit_report(request)
+        data = self._process_ga4_response(response, plan)
+        _cache_report(cache_key, data)
+        return data
+
+    def _fetch_done(self, cache_key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(cache_key) is task:
+            del self._inflight[cache_key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller has gone away
+
+    async def stream_analytics_query(
+        self, query: str, property_id: str, cache_bypass: bool = False, stream_answer: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the report rows as soon as they are ready, then the LLM summary.
+
+        With stream_answer, the summary also arrives as {"answer_delta": ...}
+        events while it is generated, before the final {"answer": ...}.
+        """
         if not self.client:
-            return {"answer": "Server credentials missing. Cannot connect to GA4.", "data": None}
+            yield {"answer": "Server credentials missing. Cannot connect to GA4.", "data": None}
+            return
 
         try:
-            logger.info(f"Running GA4 Query: {query} on Property: {property_id}")
+            logger.info("Running GA4 Query: %s on Property: %s", query, property_id)
             
             # 1. Plan
-            plan = plan_ga4_query(f"{query} for GA4 property {property_id}")
-            
-            # 2. Execute
-            request = RunReportRequest(
-                property=f"properties/{property_id}",
-                metrics=[Metric(name=m) for m in plan.get("metrics", ["activeUsers"])],
-                dimensions=[Dimension(name=d) for d in plan.get("dimensions", ["date"])],
-                date_ranges=[DateRange(
-                    start_date=plan.get("start_date", "30daysAgo"), 
-                    end_date=plan.get("end_date", "today")
-                )]
-            )
-            
-            response = self.client.run_report(request)
-            
-            # 3. Process
-            data = []
-            for row in response.rows:
-                item = {}
-                # Dimensions
-                for i, dim_val in enumerate(row.dimension_values):
-                    item[plan["dimensions"][i]] = dim_val.value
-                # Metrics
-                for i, met_val in enumerate(row.metric_values):
-                    item[plan["metrics"][i]] = met_val.value
-                data.append(item)
-            
-            # 4. Summarize
-            answer = LLMQueryPlanner.generate_natural_language_response(query, data)
+            plan = await _get_plan(query, property_id)
+            logger.debug("Generated GA4 query plan: %r", plan)
+
+            invalid = _validate_plan(plan)
+            if invalid:
+                logger.warning("Rejected GA4 plan (%s): %r", invalid, plan)
+                yield {"answer": f"Could not build a valid GA4 query: {invalid}.", "data": None, "query_plan": plan}
+                return
             
-            return {"answer": answer, "data": data, "query_plan": plan}
+            # 2. Execute (served from the report cache when possible)
+            cache_key = _report_cache_key(plan, property_id)
+            cached = None if cache_bypass else _cached_report(cache_key)
+            if cached is not None:
+                logger.info("GA4 report cache hit: %s", cache_key[:12])
+                data = cached
+            else:
+                logger.info("GA4 report cache miss: %s", cache_key[:12])
+                # 3. Fetch + process
+                data = await self._fetch_report(plan, property_id, cache_key)
             
         except Exception as e:
-            logger.error(f"GA4 Execution Error: {e}")
-            return {"answer": f"Error querying GA4: {e}", "data": None}
+            logger.error("GA4 Execution Error: %s", e)
+            yield {"answer": f"Error querying GA4: {e}", "data": None}
+            return
+
+        # The rows are complete before the summary starts, so hand them out first
+        yield {"data": data, "query_plan": plan}
+
+        # 4. Summarize
+        if not stream_answer:
+            answer = await generate_natural_language_response(query, data[:SUMMARY_ROW_LIMIT])
+            yield {"answer": answer}
+            return
+
+        parts = []
+        async for text in stream_natural_language_response(query, data[:SUMMARY_ROW_LIMIT]):
+            parts.append(text)
+            yield {"answer_delta": text}
+        yield {"answer": "".join(parts)}
+
+    async def run_analytics_query(self, query: str, property_id: str, cache_bypass: bool = False) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        async for event in self.stream_analytics_query(query, property_id, cache_bypass=cache_bypass):
+            result.update(event)
+        return result
+
+# Singleton, created on first use
+@functools.lru_cache(maxsize=1)
+def _get_agent() -> AnalyticsAgent:
+    return AnalyticsAgent()
 
-# Singleton
-analytics_agent = AnalyticsAgent()
+async def run_analytics_agent(query: str, property_id: str, cache_bypass: bool = False) -> Dict[str, Any]:
+    return await _get_agent().run_analytics_query(query, property_id, cache_bypass=cache_bypass)
 
-async def run_analytics_agent(query: str, property_id: str) -> Dict[str, Any]:
-    return await analytics_agent.run_analytics_query(query, property_id)
\ No newline at end of file
+def stream_analytics_agent(
+    query: str, property_id: str, cache_bypass: bool = False, stream_answer: bool = False
+) -> AsyncIterator[Dict[str, Any]]:
+    return _get_agent().stream_analytics_query(
+        query, property_id, cache_bypass=cache_bypass, stream_answer=stream_answer
+    )
\ No newline at end of file
@@ -1,37 +1,385 @@
 import logging
+import asyncio
 import re
-import json
+import hashlib
+import functools
+import operator
+import orjson
+import numpy as np
 import pandas as pd
-from urllib.parse import urlparse
-import litellm 
-from typing import Dict, Any, List
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from utils.sheets import load_seo_data
+from utils.llm_utils import JSON_RESPONSE_FORMAT, acompletion_with_retry, clean_json_response, compact_data
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows returned to the caller (and summarized) per query
+RESULT_ROW_LIMIT = 20
+# Entries kept in each per-agent LLM response cache
+LLM_CACHE_MAX_SIZE = 1024
+# Paths resolved between event-loop yields in batch_lookup_seo_data
+LOOKUP_YIELD_EVERY = 1000
+
+# Screaming Frog columns that hold numbers; matched once per load in a single regex pass
+NUMERIC_COLUMN_PATTERNS = [
+    r"status code", r"word count", r"inlinks", r"outlinks", r"\blength\b", r"pixel width",
+    r"\bsize\b", r"response time", r"crawl depth", r"\bdepth\b", r"link score",
+    r"\bcount\b", r"co2",
+]
+_NUMERIC_RE = re.compile("|".join(NUMERIC_COLUMN_PATTERNS), re.IGNORECASE)
+
+# Arrow-backed strings: vectorized .str kernels and no per-cell PyObject
+TEXT_DTYPE = "string[pyarrow]"
+# URL -> path, same split as urlparse(...).path (scheme://netloc stripped, query/fragment dropped)
+_URL_PATH_PATTERN = r"^(?:[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*)?(?P<path>[^?#]*)"
+
+# Comparison operators a plan filter may use
+_COMPARE_OPS = {
+    "==": operator.eq, "!=": operator.ne,
+    ">": operator.gt, ">=": operator.ge,
+    "<": operator.lt, "<=": operator.le,
+}
+
+# Bare whole-crawl "status code breakdown" questions are answered from a precomputed histogram,
+# no LLM. The whole query must match, so anything naming a subset ("... for non-indexable pages")
+# or a specific code ("how many pages return 404") is a filter and goes to the planner.
+_STATUS_HIST_RE = re.compile(
+    r"\s*(?:(?:show|give|get|list|display|tell|what(?:'s|\s+is|\s+are)?)(?:\s+(?:me|us))?\s+)?"
+    r"(?:(?:the|a|an|our)\s+)?(?:overall\s+)?"
+    r"(?:"
+    r"(?:http\s+)?status[\s-]codes?\s+(?:distribution|breakdown|histogram|summary|counts?)"
+    r"|(?:distribution|breakdown|histogram|summary|counts?)\s+(?:of|by)\s+(?:(?:the|all|http)\s+)*status[\s-]codes?"
+    r"|(?:how\s+many\s+|(?:number|count)\s+of\s+)?(?:all\s+)?(?:pages|urls)\s+(?:by|per)\s+status[\s-]codes?"
+    r")"
+    r"(?:\s+(?:across|for|in|on|of)\s+(?:(?:the|all|our|whole|entire)\s+)*(?:site|website|crawl|pages|urls|data))?"
+    r"\s*[?.!]*\s*",
+    re.IGNORECASE,
+)
+
+# Placeholders a planner response_template may use; filled by plain substitution, never str.format
+_TEMPLATE_FIELD_RE = re.compile(r"\{(num_results|total_matches|top_status)\}")
+
+# Static instructions first and the per-load column list last, so the prompt
+# prefix is identical across requests and can be served from provider prompt caching
+SEO_PLAN_PROMPT_TEMPLATE = """Analyze SEO question.
+Return JSON: {{ "limit": 10, "filters": [], "sort_by": [], "response_template": "..." }}
+"filters" is a list of {{"column": "<one of the columns>", "op": "...", "value": ...}} where op is one of
+==, !=, >, >=, <, <=, contains, not contains, starts with, in, not in, is empty, is not empty.
+"sort_by" is a list of {{"column": "<one of the columns>", "order": "asc" or "desc"}}, most significant first.
+"response_template" is a 2-3 sentence answer to the question that uses only these
+placeholders for the numbers:
+{{total_matches}} - how many pages match the filters (use this for "how many" answers),
+{{num_results}} - how many of those rows are returned (at most {row_limit}),
+{{top_status}} - the most common status code among the matching pages.
+Columns: {columns}"""
+
+# First-request Sheets pull + load_data run here, off the event loop and out of the default pool
+_load_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="seo-load")
+# Parallel first queries share one load instead of each pulling the sheet
+_load_lock = asyncio.Lock()
+
+def _normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query.lower().strip())
+
+def _fingerprint(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+def _cache_put(cache: Dict, key, value) -> None:
+    cache[key] = value
+    if len(cache) > LLM_CACHE_MAX_SIZE:
+        cache.pop(next(iter(cache)))
+
 class SEOAgent:
     def __init__(self, df: pd.DataFrame = None):
         """Initialize SEOAgent with optional DataFrame.
         
         Args:
             df: Optional DataFrame containing SEO data. If not provided,
-                it will be loaded on demand in batch_lookup_seo_data.
+                it will be loaded on demand by ensure_data.
         """
+        self.df = None
+        # (normalized query, columns fingerprint) -> parsed planner JSON
+        self._plan_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # (normalized query, prompt payload fingerprint) -> summary text
+        self._summary_cache: Dict[Tuple[str, str], str] = {}
+        # (frame, URL path -> row position, fusion fields per row); rebuilt when the frame
+        # changes and published as one tuple so readers never pair one frame's index with another's rows
+        self._path_lookup: Optional[Tuple[pd.DataFrame, Dict[str, int], List[Dict[str, Any]]]] = None
+        # Planner prompt and its cache fingerprint, rendered once per load_data
+        self._system_prompt: Optional[str] = None
+        self._columns_fingerprint: Optional[str] = None
+        # Integer status codes of every crawled row, for the status histogram fast path
+        self._status: Optional[np.ndarray] = None
+        if df is not None:
+            self.load_data(df)
+
+    def load_data(self, df: pd.DataFrame) -> None:
+        """Attach a crawl export to the agent and prepare its columns for querying."""
+        df = df.copy()
+        df.columns = [str(c).strip() for c in df.columns]
+        self._convert_numeric_columns(df)
+        text_cols = [c for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])]
+        if text_cols:
+            df[text_cols] = df[text_cols].astype(TEXT_DTYPE)
+        status = None
+        if "Status Code" in df.columns and pd.api.types.is_numeric_dtype(df["Status Code"]):
+            codes = df["Status Code"].to_numpy(dtype=np.float64, na_value=np.nan)
+            codes = codes[~np.isnan(codes)]
+            status = codes[(codes >= 0) & (codes < 1000)].astype(np.int64)
+        columns = list(df.columns)[:15]
+        self._system_prompt = SEO_PLAN_PROMPT_TEMPLATE.format(columns=columns, row_limit=RESULT_ROW_LIMIT)
+        self._columns_fingerprint = _fingerprint(",".join(map(str, columns)))
+        self._status = status
+        # Built here, on the loader's worker thread, so the first fusion lookup doesn't pay for it
+        url_col = next((c for c in df.columns if c.lower() in ['address', 'url']), None)
+        if url_col:
+            self._path_lookup = self._build_path_index(df, url_col)
+        # Published last, so a background reload never exposes a half-prepared frame
         self.df = df
 
+    async def ensure_data(self) -> Optional[pd.DataFrame]:
+        """Return the agent's frame, loading it from Sheets on a worker thread the first time."""
+        if self.df is not None:
+            return self.df
+        async with _load_lock:
+            if self.df is None:
+                loop = asyncio.get_running_loop()
+                df = await loop.run_in_executor(_load_executor, load_seo_data)
+                if df is None or df.empty:
+                    logger.error("Failed to load SEO data: no rows returned")
+                    return None
+                await loop.run_in_executor(_load_executor, self.load_data, df)
+        return self.df
+
+    async def refresh(self) -> bool:
+        """Pull the sheet again (bypassing the Sheets cache) and swap in the new frame."""
+        async with _load_lock:
+            loop = asyncio.get_running_loop()
+            df = await loop.run_in_executor(_load_executor, functools.partial(load_seo_data, force_refresh=True))
+            if df is None or df.empty:
+                logger.warning("SEO refresh returned no rows; keeping the current data")
+                return False
+            await loop.run_in_executor(_load_executor, self.load_data, df)
+        logger.info("SEO data refreshed: %d rows", len(df))
+        return True
+
+    @staticmethod
+    def _convert_numeric_columns(df: pd.DataFrame) -> None:
+        """Convert numeric-looking string columns to numbers in one bulk to_numeric pass."""
+        cands = [
+            c for c in df.columns
+            if _NUMERIC_RE.search(c) and not pd.api.types.is_numeric_dtype(df[c])
+        ]
+        if not cands:
+            return
+        raw = df[cands]
+        converted = raw.apply(pd.to_numeric, errors="coerce")
+        # Leave a column as text if coercion would drop real (non-empty) values
+        lost = converted.isna() & raw.notna() & raw.ne("")
+        numeric_cols = [c for c in cands if not lost[c].any()]
+        if not numeric_cols:
+            return
+        converted = converted[numeric_cols]
+        # Blank cells make to_numeric return float64; whole-number columns (status codes,
+        # counts) go to nullable Int64 so rows show 404 rather than 404.0
+        values = converted.to_numpy(dtype=np.float64, na_value=np.nan)
+        blank = np.isnan(values)
+        integral = (blank | (np.isfinite(values) & (values == np.floor(values)))).all(axis=0)
+        for c, is_int in zip(numeric_cols, integral):
+            if is_int and pd.api.types.is_float_dtype(converted[c]):
+                converted[c] = converted[c].astype("Int64")
+        df[numeric_cols] = converted
+
+    async def _plan_query(self, query: str) -> Dict[str, Any]:
+        """LLM planning step, served from the plan cache for repeated questions."""
+        key = (_normalize_query(query), self._columns_fingerprint)
+        if key in self._plan_cache:
+            logger.info("SEO plan cache hit")
+            return self._plan_cache[key]
+
+        response = await acompletion_with_retry(
+            model="openai/gemini-2.5-flash",
+            messages=[{"role": "system", "content": self._system_prompt}, {"role": "user", "content": query}],
+            temperature=0.0,
+            response_format=JSON_RESPONSE_FORMAT
+        )
+        try:
+            plan = orjson.loads(clean_json_response(response.choices[0].message.content))
+        except (TypeError, ValueError):
+            plan = None
+        if not isinstance(plan, dict):
+            # Not cached: one bad reply shouldn't pin this question to the default plan
+            logger.warning("Unparseable SEO plan; using the default plan for this request")
+            return {}
+        _cache_put(self._plan_cache, key, plan)
+        return plan
+
+    @staticmethod
+    def _apply_filters(df: pd.DataFrame, filters: List[Dict[str, Any]]) -> Tuple[Optional[np.ndarray], int]:
+        """AND every plan filter into one boolean mask so the frame is indexed only once.
+
+        Filters on unknown columns or with unsupported operators are skipped.
+        Returns (mask, number of skipped filters); the mask is None when no filter applies.
+        """
+        masks: List[np.ndarray] = []
+        text_cols: Dict[str, pd.Series] = {}
+        lower_cols: Dict[str, pd.Series] = {}
+
+        def as_text(col: str) -> pd.Series:
+            # Shared across several text filters on the same column
+            if col not in text_cols:
+                series = df[col]
+                text_cols[col] = (
+                    series.fillna("") if pd.api.types.is_string_dtype(series) else series.astype(str)
+                )
+            return text_cols[col]
+
+        def as_lower(col: str) -> pd.Series:
+            # Lowercased once so case-insensitive substring checks are plain scans
+            if col not in lower_cols:
+                lower_cols[col] = as_text(col).str.lower()
+            return lower_cols[col]
+
+        for f in filters or []:
+            if not isinstance(f, dict) or f.get("column") not in df.columns:
+                continue
+            col = f["column"]
+            op = str(f.get("op", "==")).lower().strip()
+            value = f.get("value")
+            series = df[col]
+            numeric = pd.api.types.is_numeric_dtype(series)
+
+            if op in _COMPARE_OPS:
+                if numeric:
+                    value = pd.to_numeric(value, errors="coerce")
+                    if pd.isna(value):
+                        continue
+                    # Nullable Int64 compares to a masked result; blanks never match
+                    masks.append(_COMPARE_OPS[op](series, value).to_numpy(dtype=bool, na_value=False))
+                elif op in ("==", "!="):
+                    masks.append(_COMPARE_OPS[op](as_text(col), str(value)).to_numpy())
+            elif op in ("contains", "not contains"):
+                hit = as_lower(col).str.contains(str(value).lower(), regex=False, na=False).to_numpy()
+                masks.append(hit if op == "contains" else ~hit)
+            elif op == "starts with":
+                masks.append(as_text(col).str.startswith(str(value), na=False).to_numpy())
+            elif op in ("in", "not in"):
+                values = value if isinstance(value, list) else [value]
+                if numeric:
+                    hit = np.isin(
+                        series.to_numpy(dtype=np.float64, na_value=np.nan),
+                        pd.to_numeric(pd.Series(values), errors="coerce").dropna().to_numpy()
+                    )
+                else:
+                    hit = np.isin(as_text(col).to_numpy(), [str(v) for v in values])
+                masks.append(hit if op == "in" else ~hit)
+            elif op in ("is empty", "is not empty"):
+                empty = series.isna().to_numpy() | (as_text(col).str.strip() == "").to_numpy()
+                masks.append(empty if op == "is empty" else ~empty)
+
+        # Each applied filter adds exactly one mask
+        skipped = len(filters or []) - len(masks)
+        return (np.logical_and.reduce(masks) if masks else None), skipped
+
+    @staticmethod
+    def _order_positions(df: pd.DataFrame, positions: np.ndarray, sort_by: Any, limit: int) -> np.ndarray:
+        """Return the first `limit` of `positions` in plan sort order.
+
+        A single numeric key uses a bounded nlargest/nsmallest selection on just
+        that column instead of sorting every matching row.
+        """
+        keys = [
+            (k["column"], str(k.get("order", "asc")).lower() != "desc")
+            for k in (sort_by if isinstance(sort_by, list) else [])
+            if isinstance(k, dict) and k.get("column") in df.columns
+        ]
+        if not keys:
+            return positions[:limit]
+
+        if len(keys) == 1 and pd.api.types.is_numeric_dtype(df[keys[0][0]]):
+            col, ascending = keys[0]
+            values = pd.Series(df[col].to_numpy(dtype=np.float64, na_value=np.nan)[positions])
+            top = values.nsmallest(limit) if ascending else values.nlargest(limit)
+            return positions[top.index.to_numpy()]
+
+        cols = [c for c, _ in keys]
+        subset = df[cols].iloc[positions].reset_index(drop=True)
+        order = subset.sort_values(by=cols, ascending=[a for _, a in keys], kind="stable").index
+        return positions[order.to_numpy()[:limit]]
+
+    def _status_histogram(self) -> Dict[str, Any]:
+        """Count crawled URLs per status code with one np.bincount over the cached codes."""
+        counts = np.bincount(self._status)
+        codes = np.flatnonzero(counts)
+        codes = codes[np.argsort(-counts[codes], kind="stable")]
+        data = [{"Status Code": int(c), "Pages": int(counts[c])} for c in codes]
+        breakdown = ", ".join(f"{r['Status Code']}: {r['Pages']}" for r in data)
+        return {
+            "answer": f"Status code breakdown across {len(self._status)} crawled URLs: {breakdown}.",
+            "data": data
+        }
+
+    @staticmethod
+    def _render_template(template: Any, metrics: Dict[str, Any]) -> Optional[str]:
+        """Fill the planner's response template, or None if it needs values we don't have."""
+        if not isinstance(template, str) or not template.strip():
+            return None
+        # Only the known placeholders are substituted; any other brace (attribute access,
+        # format specs, unknown names) means the template isn't usable as-is
+        rendered = _TEMPLATE_FIELD_RE.sub(lambda m: str(metrics[m.group(1)]), template)
+        if "{" in rendered or "}" in rendered:
+            return None
+        return rendered
+
+    async def _summarize(self, query: str, clean_data: List[Dict[str, Any]]) -> str:
+        """Summary LLM call, cached on the exact query + data snippet it would send."""
+        payload = compact_data(clean_data, max_items=RESULT_ROW_LIMIT, max_chars=3000)
+        key = (_normalize_query(query), _fingerprint(payload))
+        if key in self._summary_cache:
+            logger.info("SEO summary cache hit")
+            return self._summary_cache[key]
+
+        summ_resp = await acompletion_with_retry(
+            model="openai/gemini-2.5-flash", 
+            messages=[{"role": "user", "content": f"Summarize for '{query}': {payload}"}]
+        )
+        answer = summ_resp.choices[0].message.content
+        _cache_put(self._summary_cache, key, answer)
+        return answer
+
+    @staticmethod
+    def _build_path_index(
+        df: pd.DataFrame, url_col: str
+    ) -> Tuple[pd.DataFrame, Dict[str, int], List[Dict[str, Any]]]:
+        """Map every crawled URL path to its row once per frame, with the fields fusion returns."""
+        # One Arrow regex pass over the URL column; null URLs stay null and are skipped
+        url_series = df[url_col] if pd.api.types.is_string_dtype(df[url_col]) else df[url_col].astype(TEXT_DTYPE)
+        urls = pa.array(url_series, type=pa.string(), from_pandas=True)
+        match_paths = pc.utf8_rtrim(pc.struct_field(pc.extract_regex(urls, pattern=_URL_PATH_PATTERN), "path"), characters="/")
+        path_index = {path: pos for pos, path in enumerate(match_paths.to_pylist()) if path is not None}
+
+        def values(col: str, default: str) -> List[Any]:
+            if col not in df.columns:
+                return [default] * len(df)
+            return [default if pd.isna(v) else v for v in df[col].tolist()]
+
+        path_rows = [
+            {"title": title, "status": status, "indexability": indexability}
+            for title, status, indexability in zip(
+                values("Title 1", "N/A"), values("Status Code", "Unknown"), values("Indexability", "Unknown")
+            )
+        ]
+        # Published by the caller in a single assignment, so a lookup sees either the old triple or the new one
+        return df, path_index, path_rows
+
     async def batch_lookup_seo_data(self, paths: List[str]) -> Dict[str, Any]:
         """Fusion Lookup."""
-        # Use stored DataFrame if available, otherwise load fresh
-        if self.df is None:
-            df, error = load_seo_data()
-            if error or df.empty:
-                logger.error(f"Failed to load SEO data: {error}")
-                return {}
-        else:
-            df = self.df
-            
-        if df.empty: 
+        # Use stored DataFrame if available, otherwise load it once
+        df = await self.ensure_data()
+        if df is None or df.empty: 
             return {}
 
         lookup_map = {}
@@ -41,76 +389,118 @@ class SEOAgent:
         if not url_col: 
             return {}
 
-        # Pre-compute paths for matching
-        # Use a copy to avoid SettingWithCopy warnings on cached DF
-        match_df = df[[url_col]].copy()
-        match_df['path'] = match_df[url_col].astype(str).apply(lambda x: urlparse(x).path.rstrip('/'))
-        
-        # Create dictionary for O(1) lookup
-        # Map path -> index in original DF
-        path_to_idx = dict(zip(match_df['path'], match_df.index))
+        # Path index is built once per frame; later calls are plain dict lookups
+        lookup = self._path_lookup
+        if lookup is None or lookup[0] is not df:
+            lookup = self._build_path_index(df, url_col)
+            # A reload may already have published a newer frame's index; don't replace it
+            if df is self.df:
+                self._path_lookup = lookup
+        # Unpacked once: a reload while we yield below must not mix two frames' indexes
+        _, path_to_pos, path_rows = lookup
+
+        for i, path in enumerate(paths):
+            # Lookups are in-memory; just hand the loop back now and then on huge batches
+            if i and i % LOOKUP_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
 
-        for path in paths:
             clean_path = path.strip().rstrip('/')
             if not clean_path: clean_path = "/"
             
-            if clean_path in path_to_idx:
-                row = df.iloc[path_to_idx[clean_path]].to_dict()
-                lookup_map[path] = {
-                    "title": row.get("Title 1", "N/A"),
-                    "status": row.get("Status Code", "Unknown"),
-                    "indexability": row.get("Indexability", "Unknown")
-                }
+            if clean_path in path_to_pos:
+                lookup_map[path] = dict(path_rows[path_to_pos[clean_path]])
             else:
                 lookup_map[path] = {"error": "Not found in crawl"}
         
         return lookup_map
 
+    def _run_plan(
+        self, df: pd.DataFrame, plan: Dict[str, Any], query: str
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Any], int]:
+        """CPU-bound part of a query: filter, order and materialize rows, plus template metrics.
+
+        The last element is how many plan filters could not be applied.
+        """
+        # 2. Hybrid Filtering
+        # Only `limit` rows are returned, so pick row positions from the mask
+        # and materialize just those instead of copying/filtering the whole frame
+        limit = plan.get("limit")
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+            limit = RESULT_ROW_LIMIT
+        limit = min(limit, RESULT_ROW_LIMIT)
+        filters = plan.get("filters")
+        filters = list(filters) if isinstance(filters, list) else []
+        q = query.lower()
+
+        if "https" in q and "not" in q:
+            url_col = next((c for c in df.columns if c.lower() in ['address', 'url']), None)
+            if url_col:
+                filters.append({"column": url_col, "op": "starts with", "value": "http://"})
+
+        mask, skipped_filters = self._apply_filters(df, filters)
+        positions = np.arange(len(df)) if mask is None else mask.nonzero()[0]
+        total_matches = len(positions)
+        result_df = df.iloc[self._order_positions(df, positions, plan.get("sort_by"), limit)]
+
+        # 3. Output
+        # One pass over the row tuples builds both the response rows (blanks as "")
+        # and the LLM context rows (blanks dropped), without filling the whole frame
+        cols = list(result_df.columns)
+        result_data: List[Dict[str, Any]] = []
+        clean_data: List[Dict[str, Any]] = []
+        for row in result_df.itertuples(index=False, name=None):
+            record = {}
+            clean = {}
+            for c, v in zip(cols, row):
+                if pd.isna(v):
+                    v = ""
+                record[c] = v
+                if str(v).strip():
+                    clean[c] = v
+            result_data.append(record)
+            clean_data.append(clean)
+
+        # Values for the planner's response template
+        # top_status is the most common code among all matches, not just the returned rows
+        top_status = "N/A"
+        if "Status Code" in df.columns and total_matches:
+            modes = df["Status Code"].iloc[positions].mode()
+            if not modes.empty:
+                top_status = modes.iat[0]
+        metrics = {
+            "num_results": len(result_data),
+            "total_matches": total_matches,
+            "top_status": top_status,
+        }
+        return result_data, clean_data, metrics, skipped_filters
+
     async def execute_query(self, query: str) -> Dict[str, Any]:
-        if self.df is None:
-            df, error = load_seo_data()
-            if error or df.empty:
-                logger.error(f"Failed to load SEO data: {error}")
-                return {"answer": f"Error loading SEO data: {error}", "data": None}
-        else:
-            df = self.df
-            
-        if df.empty:
+        df = await self.ensure_data()
+        if df is None or df.empty:
              return {"answer": "No SEO data available.", "data": None}
 
         try:
+            if self._status is not None and len(self._status) and _STATUS_HIST_RE.fullmatch(query):
+                return self._status_histogram()
+
             # 1. LLM Planning
-            system_prompt = f"""Analyze SEO question. Columns: {list(df.columns)[:15]}. 
-            Return JSON: {{ "limit": 10 }}"""
+            plan = await self._plan_query(query)
             
-            response = litellm.completion(
-                model="openai/gemini-2.5-flash",
-                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": query}],
-                temperature=0.0
-            )
-            
-            # 2. Hybrid Filtering
-            result_df = df.copy()
-            q = query.lower()
+            # 2-3. Filtering and row building are pandas/numpy work; keep them off the event loop
+            result_data, clean_data, metrics, skipped_filters = await asyncio.to_thread(self._run_plan, df, plan, query)
 
-            if "https" in q and "not" in q:
-                url_col = next((c for c in result_df.columns if c.lower() in ['address', 'url']), None)
-                if url_col:
-                    result_df = result_df[result_df[url_col].astype(str).str.startswith('http://', na=False)]
-
-            # 3. Output
-            result_data = result_df.head(20).fillna("").to_dict(orient='records')
-            
-            # Clean data for LLM Context
-            clean_data = [{k:v for k,v in r.items() if str(v).strip()} for r in result_data]
+            # 4. Answer from the planner's template; only call the LLM again if it can't be filled.
+            # The template was written assuming every filter applied, so it's only used if they did
+            answer = None
+            if skipped_filters:
+                logger.info("Skipped %d SEO plan filter(s); summarizing instead of using the template", skipped_filters)
+            else:
+                answer = self._render_template(plan.get("response_template"), metrics)
+            if answer is None:
+                answer = await self._summarize(query, clean_data)
 
-            summ_resp = litellm.completion(
-                model="openai/gemini-2.5-flash", 
-                messages=[{"role": "user", "content": f"Summarize for '{query}': {str(clean_data)[:3000]}"}]
-            )
-            
             return {
-                "answer": summ_resp.choices[0].message.content,
+                "answer": answer,
                 "data": result_data
             }
 
@@ -1,23 +1,48 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import uvicorn
 import os
 import asyncio
+import orjson
+import queue
 from dotenv import load_dotenv
 import logging
+import logging.handlers
 
 from models import QueryRequest, QueryResponse
-from orchestrator import handle_query
+from orchestrator import handle_query, stream_query
 from agents.seo_agent import seo_agent
-from utils.sheets import load_seo_data
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+# Request handlers only enqueue records; a listener thread does the stdout writes
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+log_listener.start()
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
+# Seconds between background re-pulls of the SEO sheet
+SEO_REFRESH_SECS = int(os.getenv("SEO_REFRESH_SECS", "300"))
+
+async def refresh_seo_data_loop() -> None:
+    """Keep the SEO agent's in-memory crawl fresh so requests never wait on Sheets."""
+    while True:
+        await asyncio.sleep(SEO_REFRESH_SECS)
+        try:
+            await seo_agent.refresh()
+        except Exception as e:
+            logger.error(f"SEO refresh failed: {e}")
+
 # Initialize SEO Agent with data on startup
 async def initialize_seo_agent() -> bool:
     """
@@ -28,19 +53,13 @@ async def initialize_seo_agent() -> bool:
     """
     try:
         logger.info("Initializing SEO Agent...")
-        df, error = load_seo_data()
-        
-        if error:
-            logger.error(f"Failed to load SEO data: {error}")
-            return False
+        # Load into the shared agent instance that the orchestrator routes to
+        df = await seo_agent.ensure_data()
             
-        if df.empty:
+        if df is None or df.empty:
             logger.error("No SEO data loaded - empty DataFrame")
             return False
             
-        # Update the global seo_agent with the loaded data
-        global seo_agent
-        seo_agent = SEOAgent(df)
         logger.info(f"SEO Agent initialized successfully with {len(df)} rows of data")
         return True
         
@@ -48,23 +67,48 @@ async def initialize_seo_agent() -> bool:
         logger.error(f"Failed to initialize SEO Agent: {e}", exc_info=True)
         return False
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once per worker process, on the loop that serves its requests
+    seo_initialized = await initialize_seo_agent()
+    if not seo_initialized:
+        logger.warning("SEO Agent initialization failed. SEO features will not be available.")
+    else:
+        logger.info("SEO Agent is ready")
+    refresher = asyncio.create_task(refresh_seo_data_loop())
+    try:
+        yield
+    finally:
+        refresher.cancel()
+        log_listener.stop()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Spike AI Analytics & SEO API",
     description="API for querying GA4 analytics and SEO data using natural language",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS
+# Comma-separated list, e.g. "https://app.example.com,https://admin.example.com"; defaults to any origin
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "*").split(",") if o.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=600,  # let browsers cache preflight responses
 )
 
-@app.post("/query", response_model=QueryResponse)
+# Added last so it is the outermost middleware and compresses the encoded body
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
+# The orchestrator already returns the QueryResponse shape, so the result is encoded
+# directly instead of being re-validated; the model only documents the schema
+@app.post("/query", response_model=None, responses={200: {"model": QueryResponse}})
 async def query_endpoint(request: QueryRequest):
     """
     Handle natural language queries for analytics and SEO data.
@@ -76,17 +120,29 @@ async def query_endpoint(request: QueryRequest):
             query=request.query,
             property_id=request.propertyId
         )
-        return QueryResponse(**result)
+        return ORJSONResponse({"answer": result.get("answer"), "data": result.get("data")})
     except HTTPException:
         raise
     except Exception as e:
-        # Log the error (in a real app) and return 500
-        print(f"Server Error: {e}")
+        logger.exception("Server Error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"An error occurred: {str(e)}"
         )
 
+@app.post("/query/stream")
+async def query_stream_endpoint(request: QueryRequest):
+    """
+    Same as /query, but streams newline-delimited JSON events so clients get
+    the data before the natural-language answer has been generated.
+    """
+    async def events():
+        async for event in stream_query(query=request.query, property_id=request.propertyId):
+            # Same options as ORJSONResponse, so numpy values (e.g. Int64 status codes) stay numbers
+            yield orjson.dumps(event, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) + b"\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -99,13 +155,16 @@ async def health_check():
     }
 
 if __name__ == "__main__":
-    # Initialize SEO Agent before starting the server
-    seo_initialized = asyncio.run(initialize_seo_agent())
-    if not seo_initialized:
-        logger.warning("SEO Agent initialization failed. SEO features will not be available.")
-    else:
-        logger.info("SEO Agent is ready")
-
     # STRICT REQUIREMENT: Port 8080
     port = int(os.getenv("PORT", 8080))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
+    # File-watch reload is for local development only and cannot be combined with workers
+    dev = os.getenv("DEV") == "1" or os.getenv("ENV", "").lower() == "dev"
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=dev,
+        loop="uvloop",
+        http="httptools",
+        workers=1 if dev else int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )
\ No newline at end of file
@@ -1,10 +1,19 @@
-from pydantic import BaseModel
-from typing import Optional, Any
+from pydantic import BaseModel, ConfigDict
+from typing import Optional, Any, List
 
 class QueryRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     query: str
     propertyId: Optional[str] = None
 
 class QueryResponse(BaseModel):
     answer: str
-    data: Optional[Any] = None
\ No newline at end of file
+    data: Optional[Any] = None
+
+class GA4Plan(BaseModel):
+    """GA4 query plan as returned by the LLM planner; unknown keys are passed through."""
+    model_config = ConfigDict(extra="allow")
+
+    metrics: List[str] = ["activeUsers"]
+    dimensions: List[str] = ["date"]
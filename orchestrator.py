@@ -1,13 +1,225 @@
 import logging
 import asyncio
-from typing import Dict, Any, Optional
-from agents.analytics_agent import run_analytics_agent
+import re
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional, Set, Tuple
+from agents.analytics_agent import run_analytics_agent, stream_analytics_agent
 from agents.seo_agent import run_seo_agent, seo_agent # Import the instance directly for fusion
-from utils.llm_utils import LLMQueryPlanner
+from utils.llm_utils import generate_natural_language_response
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GA4_TERMS = ["user", "session", "pageview", "traffic", "ga4", "analytics", "visit", "trend", "top pages"]
+SEO_TERMS = ["seo", "title", "meta", "description", "index", "https", "status code", "missing", "tag"]
+
+# Substring match, same as `term in q`, with both intents in one compiled scan
+INTENT_RE = re.compile(
+    "(?P<ga4>" + "|".join(map(re.escape, GA4_TERMS)) + ")"
+    "|(?P<seo>" + "|".join(map(re.escape, SEO_TERMS)) + ")"
+)
+INTENT_GA4 = 1
+INTENT_SEO = 2
+
+# Row keys that identify the page in fused GA4 rows (kept out of "metrics")
+FUSION_PATH_KEYS = ("pagePath", "pagePathPlusQueryString")
+
+FusedSummary = Callable[[List[Dict[str, Any]], Set[str]], Optional[str]]
+
+def _fused_summary(metric: str, label: str, additive: bool = True) -> FusedSummary:
+    """Build a canned summary for fused rows whose headline metric is `metric`.
+
+    Users are not additive across rows, so for those metrics no total is given and
+    pages that span several rows (e.g. per date) are left to the LLM (render returns None).
+    """
+    def render(fused_data: List[Dict[str, Any]], not_in_crawl: Set[str]) -> Optional[str]:
+        totals: Dict[str, float] = {}
+        for rec in fused_data:
+            try:
+                value = float(rec["metrics"].get(metric) or 0)
+            except (TypeError, ValueError):
+                value = 0.0
+            if not additive and rec["page_path"] in totals:
+                return None
+            totals[rec["page_path"]] = totals.get(rec["page_path"], 0.0) + value
+        top_path, top_value = max(totals.items(), key=lambda kv: kv[1])
+        crawled = [rec for rec in fused_data if rec["page_path"] not in not_in_crawl]
+        missing_titles = sum(1 for rec in crawled if rec["seo_details"]["title"] in ("", "N/A"))
+        not_indexable = sum(
+            1 for rec in crawled if rec["seo_details"]["indexability"] not in ("Indexable", "N/A", "Unknown", "")
+        )
+        headline = (
+            f"Across {len(totals)} pages there were {sum(totals.values()):,.0f} {label}; "
+            if additive else f"Across {len(totals)} pages, "
+        )
+        answer = (
+            f"{headline}{top_path} leads with {top_value:,.0f} {label}. "
+            f"{missing_titles} of the {len(crawled)} crawled rows have no title "
+            f"and {not_indexable} are marked non-indexable."
+        )
+        if len(crawled) < len(fused_data):
+            answer += f" Rows for pages not found in the SEO crawl: {len(fused_data) - len(crawled)}."
+        return answer
+    return render
+
+# Sorted metric keys of a fused row -> canned summary; other shapes fall back to the LLM
+FUSION_SUMMARY_TEMPLATES: Dict[Tuple[str, ...], FusedSummary] = {
+    ("screenPageViews",): _fused_summary("screenPageViews", "page views"),
+    ("activeUsers",): _fused_summary("activeUsers", "active users", additive=False),
+    ("sessions",): _fused_summary("sessions", "sessions"),
+    ("activeUsers", "screenPageViews"): _fused_summary("screenPageViews", "page views"),
+    ("activeUsers", "sessions"): _fused_summary("sessions", "sessions"),
+}
+
+# The templates answer "which pages lead, and how do their titles/indexability look";
+# questions asking for anything else (other fields, the low end, explanations) go to the LLM
+FUSION_TEMPLATE_QUERY_RE = re.compile(r"\b(top|most|best|highest|leading)\b")
+FUSION_TEMPLATE_EXCLUDE_RE = re.compile(
+    r"\b(lowest|least|bottom|worst|fewest|missing|meta|descriptions?|h1|canonical|status|"
+    r"redirects?|broken|errors?|compare|why|how|trend|change)\b"
+)
+
+RESPONSE_CACHE_TTL = 300  # seconds
+RESPONSE_CACHE_MAX_SIZE = 2048
+# (normalized query, property_id, is_ga4, is_seo) -> (stored_at, result)
+_response_cache: "OrderedDict[Tuple[str, Optional[str], bool, bool], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+def _normalize_query(q: str) -> str:
+    return " ".join(q.split())
+
+def _cache_response(key: Tuple[str, Optional[str], bool, bool], result: Dict[str, Any]) -> None:
+    _response_cache[key] = (time.monotonic(), result)
+    _response_cache.move_to_end(key)
+    if len(_response_cache) > RESPONSE_CACHE_MAX_SIZE:
+        _response_cache.popitem(last=False)
+
+def _detect_intent(q: str) -> Tuple[bool, bool]:
+    """Return (is_ga4, is_seo) for a lowercased query."""
+    mask = 0
+    for m in INTENT_RE.finditer(q):
+        mask |= INTENT_GA4 if m.lastgroup == "ga4" else INTENT_SEO
+        if mask == INTENT_GA4 | INTENT_SEO:
+            break
+    return bool(mask & INTENT_GA4), bool(mask & INTENT_SEO)
+
+async def _fetch_ga4_rows(query: str, property_id: str) -> Dict[str, Any]:
+    """GA4 report for fusion, without the analytics-only LLM summary (fusion writes its own)."""
+    result: Dict[str, Any] = {}
+    async with aclosing(stream_analytics_agent(query, property_id)) as events:
+        async for event in events:
+            result.update(event)
+            # Rows arrive before the summary; stop there. With no rows, fusion returns
+            # the GA4 result as is, so keep going for its "no data found" answer
+            if event.get("data"):
+                break
+    return result
+
+# ---------------------------------------------------------
+# TIER 3: CROSS-AGENT DATA FUSION
+# ---------------------------------------------------------
+async def _route_fusion(query: str, property_id: Optional[str]) -> Dict[str, Any]:
+    logger.info("⚡ Executing Multi-Agent Data Fusion ⚡")
+    
+    # Step A: Get Quantitative Data from GA4 (The "Top Pages")
+    # We assume the user wants SEO details for the pages found in analytics.
+    # The SEO crawl is loaded concurrently so the lookup in Step C doesn't
+    # add a Sheets pull after the GA4 round-trip.
+    ga4_result, _ = await asyncio.gather(
+        _fetch_ga4_rows(query, property_id),
+        seo_agent.ensure_data()
+    )
+    ga4_data = ga4_result.get("data", [])
+
+    if not ga4_data or not isinstance(ga4_data, list):
+        return ga4_result # Return GA4 error or empty result if strictly empty
+    
+    # Step B: Extract Identifiers (Paths)
+    # GA4 returns paths like "/pricing" or "/". One pass resolves each row's
+    # path and splits off its metrics; the same page can appear on several
+    # rows (e.g. per date), so each distinct path is looked up once.
+    prepped = []
+    for row in ga4_data:
+        # Try common keys for path info
+        path = row.get("pagePath") or row.get("pagePathPlusQueryString") or row.get("pageLocation")
+        metrics = {k: v for k, v in row.items() if k not in FUSION_PATH_KEYS}
+        prepped.append((path or "unknown", path, metrics))
+    target_paths = list(dict.fromkeys(path for _, path, _ in prepped if path))
+    
+    # Step C: Get Qualitative Data from SEO Agent (The "Titles/Tags")
+    # We call the fusion method we just added to seo_agent
+    enrichment_map = await seo_agent.batch_lookup_seo_data(target_paths)
+    
+    # Step D: Fuse Data
+    fused_data = []
+    # Page paths with no crawl row ("N/A" details), reported apart from real missing titles
+    not_in_crawl: Set[str] = set()
+    for page_path, path, metrics in prepped:
+        # Get the matching SEO details
+        seo_details = enrichment_map.get(path, {}) if path else {}
+        if not seo_details or "error" in seo_details:
+            not_in_crawl.add(page_path)
+        
+        # Create the unified record
+        fused_data.append({
+            "page_path": page_path,
+            "metrics": metrics,
+            "seo_details": {
+                "title": seo_details.get("title", "N/A"),
+                "indexability": seo_details.get("indexability", "N/A")
+            }
+        })
+    
+    # Step E: Generate Unified Natural Language Response
+    # Plain "top pages" questions with a common metric shape are summarized from a
+    # template without an LLM round-trip
+    summary = None
+    q = query.lower()
+    if FUSION_TEMPLATE_QUERY_RE.search(q) and not FUSION_TEMPLATE_EXCLUDE_RE.search(q):
+        template = FUSION_SUMMARY_TEMPLATES.get(tuple(sorted(fused_data[0]["metrics"])))
+        if template is not None:
+            summary = template(fused_data, not_in_crawl)
+    if summary is None:
+        summary = await generate_natural_language_response(
+            f"Explain this fused Analytics and SEO data for: {query}", 
+            fused_data
+        )
+    
+    return {
+        "answer": summary,
+        "data": fused_data,
+        "meta": {"agent": "Multi-Agent Fusion"}
+    }
+
+# ---------------------------------------------------------
+# Standard Routing
+# ---------------------------------------------------------
+
+# Case B: Explicitly SEO or No Property ID (Fallback to SEO)
+async def _route_seo(query: str, property_id: Optional[str]) -> Dict[str, Any]:
+    return await run_seo_agent(query)
+
+# Case C: Analytics Only
+async def _route_analytics(query: str, property_id: Optional[str]) -> Dict[str, Any]:
+    return await run_analytics_agent(query, property_id)
+
+# (is_ga4, is_seo, has_property_id) -> route
+ROUTES = {
+    (True, True, True): _route_fusion,
+    (True, True, False): _route_seo,
+    (True, False, True): _route_analytics,
+    (True, False, False): _route_seo,
+    (False, True, True): _route_seo,
+    (False, True, False): _route_seo,
+    (False, False, True): _route_analytics,
+    (False, False, False): _route_seo,
+}
+
+async def _route(query: str, property_id: Optional[str], is_ga4: bool, is_seo: bool) -> Dict[str, Any]:
+    """Dispatch a validated query to fusion, SEO or analytics based on detected intent."""
+    return await ROUTES[(is_ga4, is_seo, bool(property_id))](query, property_id)
+
 async def handle_query(query: str, property_id: Optional[str] = None) -> Dict[str, Any]:
     """
     Tier 3 Orchestrator: Handles intent detection, routing, and data fusion.
@@ -19,83 +231,45 @@ async def handle_query(query: str, property_id: Optional[str] = None) -> Dict[st
         q = query.lower()
         
         # 1. Intent Detection
-        is_ga4 = any(term in q for term in ["user", "session", "pageview", "traffic", "ga4", "analytics", "visit", "trend", "top pages"])
-        is_seo = any(term in q for term in ["seo", "title", "meta", "description", "index", "https", "status code", "missing", "tag"])
-
-        logger.info(f"Processing: '{query}' | GA4: {is_ga4}, SEO: {is_seo}")
+        is_ga4, is_seo = _detect_intent(q)
 
-        # ---------------------------------------------------------
-        # TIER 3: CROSS-AGENT DATA FUSION
-        # ---------------------------------------------------------
-        if is_ga4 and is_seo and property_id:
-            logger.info("⚡ Executing Multi-Agent Data Fusion ⚡")
-            
-            # Step A: Get Quantitative Data from GA4 (The "Top Pages")
-            # We assume the user wants SEO details for the pages found in analytics
-            ga4_result = await run_analytics_agent(query, property_id)
-            ga4_data = ga4_result.get("data", [])
-
-            if not ga4_data or not isinstance(ga4_data, list):
-                return ga4_result # Return GA4 error or empty result if strictly empty
-            
-            # Step B: Extract Identifiers (Paths)
-            # GA4 returns paths like "/pricing" or "/"
-            target_paths = []
-            for row in ga4_data:
-                # Try common keys for path info
-                path = row.get("pagePath") or row.get("pagePathPlusQueryString") or row.get("pageLocation")
-                if path:
-                    target_paths.append(path)
-            
-            # Step C: Get Qualitative Data from SEO Agent (The "Titles/Tags")
-            # We call the fusion method we just added to seo_agent
-            enrichment_map = await seo_agent.batch_lookup_seo_data(target_paths)
-            
-            # Step D: Fuse Data
-            fused_data = []
-            for row in ga4_data:
-                path = row.get("pagePath") or row.get("pagePathPlusQueryString") or "unknown"
-                
-                # Get the matching SEO details
-                seo_details = enrichment_map.get(path, {})
-                
-                # Create the unified record
-                fused_record = {
-                    "page_path": path,
-                    "metrics": {k:v for k,v in row.items() if k not in ['pagePath', 'pagePathPlusQueryString']},
-                    "seo_details": {
-                        "title": seo_details.get("title", "N/A"),
-                        "indexability": seo_details.get("indexability", "N/A")
-                    }
-                }
-                fused_data.append(fused_record)
-            
-            # Step E: Generate Unified Natural Language Response
-            summary = LLMQueryPlanner.generate_natural_language_response(
-                f"Explain this fused Analytics and SEO data for: {query}", 
-                fused_data
-            )
-            
-            return {
-                "answer": summary,
-                "data": fused_data,
-                "meta": {"agent": "Multi-Agent Fusion"}
-            }
+        logger.info("Processing: '%s' | GA4: %s, SEO: %s", query, is_ga4, is_seo)
 
-        # ---------------------------------------------------------
-        # Standard Routing
-        # ---------------------------------------------------------
-        
-        # Case B: Explicitly SEO or No Property ID (Fallback to SEO)
-        if is_seo or not property_id:
-            return await run_seo_agent(query)
+        # 2. Repeated questions are answered from the response cache
+        cache_key = (_normalize_query(q), property_id, is_ga4, is_seo)
+        cached = _response_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < RESPONSE_CACHE_TTL:
+            logger.info("Response cache hit")
+            return cached[1]
 
-        # Case C: Analytics Only
-        return await run_analytics_agent(query, property_id)
+        result = await _route(query, property_id, is_ga4, is_seo)
+        # Errors come back with data=None; only cache real answers
+        if result.get("data") is not None:
+            _cache_response(cache_key, result)
+        return result
 
     except Exception as e:
-        logger.error(f"Orchestrator Error: {str(e)}")
+        logger.error("Orchestrator Error: %s", e)
         return {
             "answer": f"An error occurred: {str(e)}",
             "data": None
-        }
\ No newline at end of file
+        }
+
+async def stream_query(query: str, property_id: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of handle_query. Analytics-only queries emit the report
+    data, then the LLM summary as "answer_delta" chunks and a final "answer";
+    every other route emits its single result.
+    """
+    if query and query.strip() and property_id:
+        is_ga4, is_seo = _detect_intent(query.lower())
+        if not is_seo:
+            try:
+                async for event in stream_analytics_agent(query, property_id, stream_answer=True):
+                    yield event
+            except Exception as e:
+                logger.error("Orchestrator Error: %s", e)
+                yield {"answer": f"An error occurred: {str(e)}", "data": None}
+            return
+
+    yield await handle_query(query, property_id)
\ No newline at end of file
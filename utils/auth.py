@@ -1,10 +1,37 @@
+import functools
+from typing import Tuple
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
+from google.analytics.data_v1beta.services.beta_analytics_data.transports import BetaAnalyticsDataGrpcTransport
 from google.oauth2 import service_account
 
+GA4_SCOPES = ("https://www.googleapis.com/auth/analytics.readonly",)
+SHEETS_SCOPES = ("https://www.googleapis.com/auth/spreadsheets.readonly",)
 
-def get_ga4_client():
-    credentials = service_account.Credentials.from_service_account_file(
-        "credentials.json",
-        scopes=["https://www.googleapis.com/auth/analytics.readonly"]
+GA4_HOST = "analyticsdata.googleapis.com:443"
+# Keep the shared HTTP/2 channel warm between bursts of dashboard traffic
+GRPC_CHANNEL_OPTIONS = (
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+)
+
+
+@functools.lru_cache(maxsize=4)
+def load_credentials(path: str, scopes: Tuple[str, ...]) -> service_account.Credentials:
+    """Parse a service-account key file once per (path, scopes) and reuse the result."""
+    return service_account.Credentials.from_service_account_file(path, scopes=list(scopes))
+
+
+@functools.lru_cache(maxsize=4)
+def get_ga4_client(credentials_path: str = "credentials.json") -> BetaAnalyticsDataClient:
+    """Return one GA4 client (and gRPC channel) per key file, shared by every caller."""
+    credentials = load_credentials(credentials_path, GA4_SCOPES)
+    channel = BetaAnalyticsDataGrpcTransport.create_channel(
+        GA4_HOST,
+        credentials=credentials,
+        options=list(GRPC_CHANNEL_OPTIONS)
     )
-    return BetaAnalyticsDataClient(credentials=credentials)
+    return BetaAnalyticsDataClient(transport=BetaAnalyticsDataGrpcTransport(channel=channel))
\ No newline at end of file
@@ -1,11 +1,73 @@
-ALLOWED_METRICS = {
-    "users",
+# GA4 Data API names the planner is allowed to request.
+# Frozen so membership checks are O(1) and the sets are shared read-only.
+ALLOWED_METRICS = frozenset({
+    "activeUsers",
+    "newUsers",
+    "totalUsers",
     "sessions",
-    "screenPageViews"
-}
+    "engagedSessions",
+    "engagementRate",
+    "bounceRate",
+    "averageSessionDuration",
+    "sessionsPerUser",
+    "screenPageViews",
+    "screenPageViewsPerSession",
+    "screenPageViewsPerUser",
+    "userEngagementDuration",
+    "eventCount",
+    "eventCountPerUser",
+    "conversions",
+    "keyEvents",
+    "totalRevenue",
+    "purchaseRevenue",
+    "transactions",
+    "ecommercePurchases",
+    "addToCarts",
+    "checkouts",
+    "itemsViewed",
+    "dauPerMau",
+    "dauPerWau",
+    "wauPerMau",
+})
 
-ALLOWED_DIMENSIONS = {
+ALLOWED_DIMENSIONS = frozenset({
     "date",
+    "dateHour",
+    "day",
+    "dayOfWeek",
+    "week",
+    "month",
+    "year",
+    "hour",
     "pagePath",
-    "sessionSource"
-}
+    "pagePathPlusQueryString",
+    "pageLocation",
+    "pageTitle",
+    "pageReferrer",
+    "landingPage",
+    "landingPagePlusQueryString",
+    "hostName",
+    "sessionSource",
+    "sessionMedium",
+    "sessionSourceMedium",
+    "sessionCampaignName",
+    "sessionDefaultChannelGroup",
+    "firstUserSource",
+    "firstUserMedium",
+    "firstUserDefaultChannelGroup",
+    "source",
+    "medium",
+    "deviceCategory",
+    "operatingSystem",
+    "browser",
+    "platform",
+    "country",
+    "region",
+    "city",
+    "language",
+    "eventName",
+    "newVsReturning",
+})
+
+# Custom definitions are project specific, so accept them by prefix
+CUSTOM_FIELD_PREFIXES = ("customEvent:", "customUser:", "customItem:")
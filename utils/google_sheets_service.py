@@ -1,12 +1,19 @@
 import os
 import logging
 import re
-from typing import List, Dict, Any, Optional
-from google.oauth2 import service_account
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from utils.auth import load_credentials, SHEETS_SCOPES
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 logger = logging.getLogger(__name__)
 
+# Tab titles per spreadsheet -> (fetched_at, titles); lets a refresh go straight to
+# batchGet instead of a metadata round-trip first. New tabs show up after the TTL.
+SHEET_NAMES_TTL = int(os.getenv("SHEET_NAMES_TTL", "3600"))
+_sheet_names_cache: Dict[str, Tuple[float, List[str]]] = {}
+
 class GoogleSheetsService:
     def __init__(self, credentials_path: str = "credentials.json"):
         self.credentials_path = credentials_path
@@ -20,10 +27,7 @@ class GoogleSheetsService:
                 self.credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', self.credentials_path)
 
             if os.path.exists(self.credentials_path):
-                creds = service_account.Credentials.from_service_account_file(
-                    self.credentials_path, 
-                    scopes=['https://www.googleapis.com/auth/spreadsheets.readonly']
-                )
+                creds = load_credentials(self.credentials_path, SHEETS_SCOPES)
                 self.service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
             else:
                 logger.warning("⚠️ No credentials found. Sheets API will fail.")
@@ -34,6 +38,21 @@ class GoogleSheetsService:
         match = re.search(r"/d/([a-zA-Z0-9-_]+)", url)
         return match.group(1) if match else None
 
+    # Field masks keep both responses to the parts read below, so less JSON is downloaded and decoded
+    def _get_sheet_names(self, spreadsheet_id: str) -> List[str]:
+        meta = self.service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields="sheets.properties.title"
+        ).execute()
+        return [s['properties']['title'] for s in meta.get('sheets', [])]
+
+    def _batch_get(self, spreadsheet_id: str, sheet_names: List[str]) -> Dict[str, Any]:
+        return self.service.spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheet_id,
+            ranges=sheet_names,
+            fields="valueRanges.values"
+        ).execute()
+
     def get_all_sheets_data(self, spreadsheet_url: str) -> Dict[str, List[List[Any]]]:
         """Returns { 'SheetName': [[row1], [row2]] }"""
         if not self.service: return {}
@@ -43,14 +62,21 @@ class GoogleSheetsService:
 
         try:
             # 1. Get Sheet Names
-            meta = self.service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheet_names = [s['properties']['title'] for s in meta.get('sheets', [])]
-            
-            # 2. Batch Get Data
-            result = self.service.spreadsheets().values().batchGet(
-                spreadsheetId=spreadsheet_id,
-                ranges=sheet_names
-            ).execute()
+            result = None
+            cached = _sheet_names_cache.get(spreadsheet_id)
+            if cached and time.time() - cached[0] < SHEET_NAMES_TTL:
+                sheet_names = cached[1]
+                try:
+                    result = self._batch_get(spreadsheet_id, sheet_names)
+                except HttpError as e:
+                    # A cached tab was renamed or deleted; re-read the titles below
+                    logger.info(f"Cached sheet names rejected ({e.resp.status}); refetching")
+
+            if result is None:
+                sheet_names = self._get_sheet_names(spreadsheet_id)
+                _sheet_names_cache[spreadsheet_id] = (time.time(), sheet_names)
+                # 2. Batch Get Data
+                result = self._batch_get(spreadsheet_id, sheet_names)
             
             all_data = {}
             value_ranges = result.get('valueRanges', [])
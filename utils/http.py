@@ -0,0 +1,10 @@
+import httpx
+
+# One pooled async client for all outbound LLM traffic in this process, so
+# concurrent requests reuse keep-alive connections instead of re-handshaking.
+# HTTP/2 is negotiated via ALPN on TLS endpoints; plain-http hosts stay on HTTP/1.1.
+ASYNC_HTTPX = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    timeout=30
+)
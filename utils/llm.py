@@ -1,51 +1,59 @@
-import time
-from openai import OpenAI, APIError
+import asyncio
+import logging
+import random
+from openai import AsyncOpenAI, APIError
+from .http import ASYNC_HTTPX
+
+logger = logging.getLogger(__name__)
 
 # LiteLLM proxy details
 BASE_URL = "http://3.110.18.218"
 MODEL = "gemini-2.5-flash"
 
 # ⚠️ Store key in environment variable in real setups
-client = OpenAI(
+# Module-level singleton so every call reuses the same keep-alive connection pool
+client = AsyncOpenAI(
     base_url=BASE_URL,
-    api_key="YOUR_LITELLM_API_KEY"
+    api_key="YOUR_LITELLM_API_KEY",
+    http_client=ASYNC_HTTPX
 )
 
 MAX_RETRIES = 5
 BASE_DELAY = 1  # seconds
+MAX_DELAY = 60  # seconds
 
 
-def call_llm(messages):
+async def call_llm(messages):
     """
     Calls LiteLLM (Gemini) with exponential backoff for 429 errors.
     """
     for attempt in range(MAX_RETRIES):
         try:
-            response = client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=MODEL,
                 messages=messages,
                 temperature=0.2
             )
 
-            print(f"LLM call successful after {attempt + 1} attempt(s)")
+            logger.debug("LLM call successful after %d attempt(s)", attempt + 1)
             return response.choices[0].message.content
 
         except APIError as e:
             # Handle rate limiting
             if e.status_code == 429:
-                wait_time = BASE_DELAY * (2 ** attempt)
-                print(
-                    f"Rate limited (429). "
-                    f"Retrying in {wait_time}s "
-                    f"(attempt {attempt + 1}/{MAX_RETRIES})..."
+                # Jitter keeps concurrent callers from retrying in lockstep
+                wait_time = min(MAX_DELAY, BASE_DELAY * (2 ** attempt) + random.random())
+                logger.warning(
+                    "Rate limited (429). Retrying in %.1fs (attempt %d/%d)...",
+                    wait_time, attempt + 1, MAX_RETRIES,
                 )
-                time.sleep(wait_time)
+                await asyncio.sleep(wait_time)
             else:
-                print(f"LLM API error (status {e.status_code}): {e}")
+                logger.warning("LLM API error (status %s): %s", e.status_code, e)
                 raise e
 
         except Exception as e:
-            print(f"Unexpected LLM error: {e}")
+            logger.warning("Unexpected LLM error: %s", e)
             raise e
 
     # If all retries failed
@@ -1,9 +1,19 @@
 import os
+import asyncio
+import itertools
+import logging
+import random
 import re
-import json
-from typing import Dict, Any
+import orjson
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, AsyncIterator, List, Optional, Set, Tuple
 import litellm
 from dotenv import load_dotenv
+from models import GA4Plan
+from utils.http import ASYNC_HTTPX
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -11,78 +21,321 @@ load_dotenv()
 # Configure LiteLLM
 litellm.api_key = os.getenv("LITELLM_API_KEY")
 litellm.api_base = "http://3.110.18.218"
+# Share the process-wide connection pool for every acompletion call
+litellm.aclient_session = ASYNC_HTTPX
 
-class LLMQueryPlanner:
-    
-    @staticmethod
-    def _clean_json_response(response_text: str) -> str:
-        """Removes Markdown formatting (```json ... ```) from LLM response."""
-        cleaned = re.sub(r'```json\s*', '', response_text)
-        cleaned = re.sub(r'```\s*', '', cleaned)
-        return cleaned.strip()
-
-    @staticmethod
-    def plan_ga4_query(natural_language_query: str) -> Dict[str, Any]:
-        """Convert natural language query to GA4 query parameters."""
-        system_prompt = """You are a Google Analytics 4 expert. Convert the question into a valid API query JSON.
-        Required JSON Structure:
-        {
-            "metrics": ["activeUsers", "sessions"], 
-            "dimensions": ["date"], 
-            "start_date": "YYYY-MM-DD",
-            "end_date": "YYYY-MM-DD",
-            "filters": {},
-            "limit": 1000
-        }
-        Use 'activeUsers' instead of 'users'. Use 'screenPageViews' for page views.
-        Default to last 28 days if no date specified.
-        """
-        
+# Kept byte-identical across calls so provider-side prompt prefix caching applies.
+GA4_PLAN_SYSTEM_PROMPT = """You are a Google Analytics 4 expert. Convert the question into a valid API query JSON.
+Required JSON Structure:
+{
+    "metrics": ["activeUsers", "sessions"],
+    "dimensions": ["date"],
+    "start_date": "YYYY-MM-DD",
+    "end_date": "YYYY-MM-DD",
+    "filters": {},
+    "limit": 1000
+}
+Use 'activeUsers' instead of 'users'. Use 'screenPageViews' for page views.
+Default to last 28 days if no date specified.
+"filters" maps a dimension name to {"match_type": "EXACT" | "BEGINS_WITH" | "ENDS_WITH" | "CONTAINS" | "FULL_REGEXP", "value": "..."}.
+
+Examples:
+USER_QUERY: daily active users last week
+{"metrics": ["activeUsers"], "dimensions": ["date"], "start_date": "7daysAgo", "end_date": "today", "filters": {}, "limit": 1000}
+USER_QUERY: top 10 pages by page views in the last 30 days
+{"metrics": ["screenPageViews"], "dimensions": ["pagePath"], "start_date": "30daysAgo", "end_date": "today", "filters": {}, "limit": 10}
+
+The user message contains USER_QUERY and, when known, PROPERTY_ID. Return only the JSON object.
+"""
+
+# Same instructions (and cacheable prefix) as the single-query prompt, plus the batch contract
+GA4_PLAN_BATCH_SYSTEM_PROMPT = GA4_PLAN_SYSTEM_PROMPT + """
+The user message may instead hold several numbered queries, one per line, as
+"[i] USER_QUERY: ... | PROPERTY_ID: ...". Then return {"plans": [...]} where element i
+is the JSON object for query [i], with exactly one element per query.
+"""
+
+SUMMARY_SYSTEM_PROMPT = "Summarize this analytics/SEO data in 2-3 concise sentences. If data is empty, politely say no data was found."
+
+# System messages are built once; calls only append their own user message
+_PLAN_MESSAGES = ({"role": "system", "content": GA4_PLAN_SYSTEM_PROMPT},)
+_PLAN_BATCH_MESSAGES = ({"role": "system", "content": GA4_PLAN_BATCH_SYSTEM_PROMPT},)
+_SUMMARY_MESSAGES = ({"role": "system", "content": SUMMARY_SYSTEM_PROMPT},)
+
+# Concurrent plan_ga4_query calls within this window share one LLM request
+# (opt-in via SPIKEAI_PLAN_BATCHING=1). Only calls for the same property are grouped,
+# so one caller's query text never shares a prompt with another property's.
+PLAN_BATCHING_ENABLED = os.getenv("SPIKEAI_PLAN_BATCHING") == "1"
+PLAN_BATCH_WINDOW_SECS = 0.025
+PLAN_BATCH_MAX_SIZE = 16
+# property_id -> queued (query, future) pairs
+_pending_plans: Dict[Optional[str], List[Tuple[str, asyncio.Future]]] = {}
+_plan_batch_tasks: Set[asyncio.Task] = set()
+
+# Rows/items of the data shown to the summary LLM, before the character cap
+SUMMARY_MAX_ITEMS = 20
+SUMMARY_MAX_CHARS = 2000
+
+def compact_data(data: Any, max_items: int = SUMMARY_MAX_ITEMS, max_chars: int = SUMMARY_MAX_CHARS) -> str:
+    """Serialize a preview of data for a prompt without encoding all of it first.
+
+    pandas objects are never formatted with str()/repr(), which lays out every cell.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = data.head(max_items).to_dict(orient="records")
+    elif isinstance(data, pd.Series):
+        data = data.head(max_items).to_dict()
+    elif isinstance(data, (list, tuple, np.ndarray)):
+        data = data[:max_items]
+    elif isinstance(data, dict) and len(data) > max_items:
+        data = dict(itertools.islice(data.items(), max_items))
+    return orjson.dumps(data, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)[:max_chars].decode(errors="ignore")
+
+# Constrains planner replies to a bare JSON object (no Markdown fences or prose)
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+# Every completion is bounded by LLM_TIMEOUT_SECS and retried on transient failures
+LLM_TIMEOUT_SECS = 15
+LLM_MAX_RETRIES = 3
+LLM_BASE_DELAY = 1  # seconds
+LLM_MAX_DELAY = 8  # seconds
+RETRYABLE_LLM_ERRORS = (
+    litellm.RateLimitError,
+    litellm.APIConnectionError,
+    litellm.Timeout,
+    litellm.InternalServerError,
+    litellm.ServiceUnavailableError,
+)
+
+async def acompletion_with_retry(**kwargs: Any) -> Any:
+    """litellm.acompletion with a timeout and jittered exponential backoff on 429/5xx/connection errors."""
+    kwargs.setdefault("timeout", LLM_TIMEOUT_SECS)
+    for attempt in range(LLM_MAX_RETRIES):
         try:
-            # FIX: Changed model to 'gemini-2.5-flash' as per Hackathon PDF requirements
-            response = litellm.completion(
-                model="openai/gemini-2.5-flash",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": natural_language_query}
-                ],
-                temperature=0.0
+            return await litellm.acompletion(**kwargs)
+        except RETRYABLE_LLM_ERRORS as e:
+            if attempt == LLM_MAX_RETRIES - 1:
+                raise
+            # Jitter keeps concurrent callers from retrying in lockstep
+            wait_time = min(LLM_MAX_DELAY, LLM_BASE_DELAY * (2 ** attempt) + random.random())
+            logger.warning(
+                "LLM call failed (%s); retrying in %.1fs (attempt %d/%d)",
+                type(e).__name__, wait_time, attempt + 1, LLM_MAX_RETRIES
             )
-            
-            content = response.choices[0].message.content
-            cleaned_json = LLMQueryPlanner._clean_json_response(content)
-            query_plan = json.loads(cleaned_json)
-            
-            # Basic Defaults
-            if "metrics" not in query_plan: query_plan["metrics"] = ["activeUsers"]
-            if "dimensions" not in query_plan: query_plan["dimensions"] = ["date"]
-            
-            return query_plan
-            
-        except Exception as e:
-            print(f"LLM Planning Error: {e}")
-            # Fallback
+            await asyncio.sleep(wait_time)
+
+# Metric phrasings the fast paths below understand -> GA4 metric
+FAST_PATH_METRICS = {
+    "active users": "activeUsers",
+    "users": "activeUsers",
+    "new users": "newUsers",
+    "sessions": "sessions",
+    "page views": "screenPageViews",
+    "pageviews": "screenPageViews",
+}
+_METRIC_ALT = "|".join(sorted(map(re.escape, FAST_PATH_METRICS), key=len, reverse=True))
+_LAST_N_DAYS = r"(?: (?:in|for|over))?(?: the)? (?:last|past) (?P<days>[1-9]\d{0,2}) days"
+
+# Whole-query templates planned without the LLM; anything else goes to the model
+_FAST_PATHS = [
+    # "daily active users last 30 days", "sessions over the past 7 days"
+    (re.compile(rf"(?:show |get )?(?:daily )?(?P<metric>{_METRIC_ALT}){_LAST_N_DAYS}"),
+     lambda m: {"dimensions": ["date"], "limit": 1000}),
+    # "top 10 pages by page views in the last 30 days"
+    (re.compile(rf"(?:show |get )?top (?P<n>[1-9]\d{{0,3}}) pages by (?P<metric>{_METRIC_ALT}){_LAST_N_DAYS}"),
+     lambda m: {"dimensions": ["pagePath"], "limit": int(m.group("n"))}),
+]
+
+def _fast_path_plan(natural_language_query: str) -> Optional[Dict[str, Any]]:
+    q = " ".join(natural_language_query.lower().split()).rstrip("?.!")
+    for pattern, build in _FAST_PATHS:
+        m = pattern.fullmatch(q)
+        if m:
             return {
-                "metrics": ["activeUsers"],
-                "dimensions": ["date"],
-                "start_date": "30daysAgo",
-                "end_date": "today"
+                "metrics": [FAST_PATH_METRICS[m.group("metric")]],
+                "start_date": f"{m.group('days')}daysAgo",
+                "end_date": "today",
+                "filters": {},
+                **build(m),
             }
+    return None
+
+def _fallback_plan() -> Dict[str, Any]:
+    return {
+        "metrics": ["activeUsers"],
+        "dimensions": ["date"],
+        "start_date": "30daysAgo",
+        "end_date": "today"
+    }
 
-    @staticmethod
-    def generate_natural_language_response(query: str, data: Any) -> str:
-        """Summarize data."""
-        system_prompt = "Summarize this analytics/SEO data in 2-3 concise sentences. If data is empty, politely say no data was found."
+def clean_json_response(response_text: str) -> str:
+    """Removes Markdown formatting (```json ... ```) from LLM response.
+
+    Planner calls request JSON_RESPONSE_FORMAT, so fences should not appear;
+    this stays as a cheap guard for backends that ignore response_format.
+    """
+    # Fences only ever wrap the whole reply, so check the ends instead of scanning it
+    cleaned = response_text.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned[3:]
+        if cleaned[:4].lower() == "json":
+            cleaned = cleaned[4:]
+        if cleaned.endswith("```"):
+            cleaned = cleaned[:-3]
+    return cleaned.strip()
+
+async def plan_ga4_query(natural_language_query: str, property_id: Optional[str] = None) -> Dict[str, Any]:
+    """Convert natural language query to GA4 query parameters.
+
+    Queries that match a _FAST_PATHS template are planned locally. With
+    PLAN_BATCHING_ENABLED, calls for the same property arriving within
+    PLAN_BATCH_WINDOW_SECS of each other share one LLM request (see plan_ga4_queries).
+    """
+    plan = _fast_path_plan(natural_language_query)
+    if plan is not None:
+        return plan
+    if not PLAN_BATCHING_ENABLED:
+        return await _plan_single(natural_language_query, property_id)
+
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    pending = _pending_plans.setdefault(property_id, [])
+    pending.append((natural_language_query, fut))
+    if len(pending) >= PLAN_BATCH_MAX_SIZE:
+        _flush_plan_batch(property_id)
+    elif len(pending) == 1:
+        loop.call_later(PLAN_BATCH_WINDOW_SECS, _flush_plan_batch, property_id)
+    return await fut
+
+def _flush_plan_batch(property_id: Optional[str]) -> None:
+    batch = _pending_plans.pop(property_id, None)
+    if not batch:
+        return
+    task = asyncio.get_running_loop().create_task(_run_plan_batch(property_id, batch))
+    _plan_batch_tasks.add(task)
+    task.add_done_callback(_plan_batch_tasks.discard)
+
+async def _run_plan_batch(property_id: Optional[str], batch: List[Tuple[str, asyncio.Future]]) -> None:
+    live = [(q, fut) for q, fut in batch if not fut.done()]
+    if not live:
+        return
+    try:
+        plans = await plan_ga4_queries([(q, property_id) for q, _ in live])
+    except Exception as e:
+        for _, fut in live:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    for (_, fut), plan in zip(live, plans):
+        if not fut.done():
+            fut.set_result(plan)
+
+async def plan_ga4_queries(queries: List[Tuple[str, Optional[str]]]) -> List[Dict[str, Any]]:
+    """Plan several (query, property_id) pairs with one LLM call; plans come back in order."""
+    if len(queries) == 1:
+        return [await _plan_single(*queries[0])]
+
+    lines = []
+    for i, (query, property_id) in enumerate(queries):
+        line = f"[{i}] USER_QUERY: {query}"
+        if property_id:
+            line += f" | PROPERTY_ID: {property_id}"
+        lines.append(line)
+
+    try:
+        response = await acompletion_with_retry(
+            model="openai/gemini-2.5-flash",
+            messages=[*_PLAN_BATCH_MESSAGES, {"role": "user", "content": "\n".join(lines)}],
+            temperature=0.0,
+            response_format=JSON_RESPONSE_FORMAT
+        )
+        parsed = orjson.loads(clean_json_response(response.choices[0].message.content))
+        raw_plans = parsed.get("plans") if isinstance(parsed, dict) else parsed
+        if not isinstance(raw_plans, list) or len(raw_plans) != len(queries):
+            raise ValueError(f"expected {len(queries)} plans, got {type(raw_plans).__name__}")
+    except RETRYABLE_LLM_ERRORS as e:
+        # Already retried; re-sending each query separately would only add load
+        logger.warning("LLM Batch Planning Error: %s", e)
+        return [_fallback_plan() for _ in queries]
+    except Exception as e:
+        # One bad batch reply shouldn't fail every caller; plan them individually instead
+        logger.warning("LLM Batch Planning Error: %s", e)
+        return list(await asyncio.gather(*(_plan_single(q, pid) for q, pid in queries)))
+
+    plans = []
+    for raw in raw_plans:
         try:
-            # FIX: Changed model to 'gemini-2.5-flash'
-            response = litellm.completion(
-                model="openai/gemini-2.5-flash",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Query: {query}\nData: {str(data)[:2000]}"}
-                ],
-                temperature=0.3
-            )
-            return response.choices[0].message.content
-        except Exception:
-            return "Here is the data requested."
\ No newline at end of file
+            plans.append(GA4Plan.model_validate(raw).model_dump())
+        except Exception as e:
+            logger.warning("LLM Planning Error: %s", e)
+            plans.append(_fallback_plan())
+    return plans
+
+async def _plan_single(natural_language_query: str, property_id: Optional[str] = None) -> Dict[str, Any]:
+    """One LLM request for one query."""
+    # Static instructions stay in the system message so the provider can reuse
+    # the cached prompt prefix; only the user message varies per call.
+    user_content = f"USER_QUERY: {natural_language_query}"
+    if property_id:
+        user_content += f"\nPROPERTY_ID: {property_id}"
+
+    try:
+        # FIX: Changed model to 'gemini-2.5-flash' as per Hackathon PDF requirements
+        response = await acompletion_with_retry(
+            model="openai/gemini-2.5-flash",
+            messages=[*_PLAN_MESSAGES, {"role": "user", "content": user_content}],
+            temperature=0.0,
+            response_format=JSON_RESPONSE_FORMAT
+        )
+        
+        content = response.choices[0].message.content
+        cleaned_json = clean_json_response(content)
+        # Basic Defaults come from the GA4Plan model
+        return GA4Plan.model_validate(orjson.loads(cleaned_json)).model_dump()
+        
+    except Exception as e:
+        logger.warning("LLM Planning Error: %s", e)
+        # Fallback
+        return _fallback_plan()
+
+async def generate_natural_language_response(query: str, data: Any) -> str:
+    """Summarize data."""
+    try:
+        # FIX: Changed model to 'gemini-2.5-flash'
+        response = await acompletion_with_retry(
+            model="openai/gemini-2.5-flash",
+            messages=[*_SUMMARY_MESSAGES, {"role": "user", "content": f"Query: {query}\nData: {compact_data(data)}"}],
+            temperature=0.3
+        )
+        return response.choices[0].message.content
+    except Exception:
+        return "Here is the data requested."
+
+async def stream_natural_language_response(query: str, data: Any) -> AsyncIterator[str]:
+    """Summarize data, yielding text chunks as the model produces them."""
+    yielded = False
+    try:
+        response = await acompletion_with_retry(
+            model="openai/gemini-2.5-flash",
+            messages=[*_SUMMARY_MESSAGES, {"role": "user", "content": f"Query: {query}\nData: {compact_data(data)}"}],
+            temperature=0.3,
+            stream=True
+        )
+        async for chunk in response:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                yielded = True
+                yield text
+    except Exception as e:
+        logger.warning("LLM Summary Stream Error: %s", e)
+        # Appending the fallback to a partial answer would garble it; keep what was sent
+        if not yielded:
+            yield "Here is the data requested."
+
+class LLMQueryPlanner:
+    """Namespace kept for callers of the old class-based API."""
+    _clean_json_response = staticmethod(clean_json_response)
+    plan_ga4_query = staticmethod(plan_ga4_query)
+    plan_ga4_queries = staticmethod(plan_ga4_queries)
+    generate_natural_language_response = staticmethod(generate_natural_language_response)
+    stream_natural_language_response = staticmethod(stream_natural_language_response)
@@ -1,24 +1,171 @@
+import itertools
+import re
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import os
 import time
+import tempfile
 import logging
+import threading
+from typing import Dict, List, Optional
 from utils.google_sheets_service import GoogleSheetsService
 
 logger = logging.getLogger(__name__)
 
 _cache = {"df": None, "timestamp": 0}
+CACHE_TTL = 300  # seconds before a background re-pull is started
+# Held while pulling from Sheets, so concurrent misses make one API call
+_cache_lock = threading.Lock()
+# Held by the background refresh thread while it runs
+_refresh_lock = threading.Lock()
 
-def load_seo_data() -> pd.DataFrame:
-    global _cache
-    if _cache["df"] is not None and (time.time() - _cache["timestamp"] < 300):
-        return _cache["df"]
+SHEET_URL = os.getenv("SEO_SHEET_URL", "https://docs.google.com/spreadsheets/d/1zzf4ax_H2WiTBVrJigGjF2Q3Yz-qy2qMCbAMKvl6VEE/edit")
+_sheet_id = re.search(r"/d/([a-zA-Z0-9-_]+)", SHEET_URL)
 
+# On-disk copy of the last Sheets pull, so cold starts can skip the API.
+# Named per spreadsheet so a different SEO_SHEET_URL never reads a stale crawl.
+SNAPSHOT_PATH = os.getenv(
+    "SEO_SNAPSHOT_PATH",
+    os.path.join(
+        tempfile.gettempdir(),
+        f"seo_cache_{_sheet_id.group(1)}.parquet" if _sheet_id else "seo_cache.parquet",
+    ),
+)
+SNAPSHOT_MAX_AGE = int(os.getenv("SEO_SNAPSHOT_MAX_AGE", "3600"))
+
+def _read_snapshot(max_age: int = SNAPSHOT_MAX_AGE) -> Optional[pd.DataFrame]:
+    """Memory-map the Parquet snapshot if it is younger than max_age seconds, else return None."""
+    try:
+        if time.time() - os.path.getmtime(SNAPSHOT_PATH) > max_age:
+            return None
+        df = pq.read_table(SNAPSHOT_PATH, memory_map=True).to_pandas()
+        logger.info(f"✅ Loaded {len(df)} rows from snapshot {SNAPSHOT_PATH}.")
+        return df
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Ignoring unreadable SEO snapshot: {e}")
+        return None
+
+def _write_snapshot(df: pd.DataFrame) -> None:
+    # Write to a unique file beside the target and rename, so readers never see
+    # a partial file and concurrent workers don't clobber each other's writes
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(SNAPSHOT_PATH) or ".",
+            prefix=os.path.basename(SNAPSHOT_PATH) + ".",
+            suffix=".tmp",
+        )
+        os.close(fd)
+        df.to_parquet(tmp_path, compression="zstd", index=False)
+        os.replace(tmp_path, SNAPSHOT_PATH)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not write SEO snapshot: {e}")
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def _dedupe_headers(headers: List[str]) -> List[str]:
+    """Suffix repeated headers as "Name.1", "Name.2", ... the way pandas.read_csv does."""
+    counts: Dict[str, int] = {}
+    deduped = []
+    for header in headers:
+        count = counts.get(header, 0)
+        counts[header] = count + 1
+        while count:
+            suffixed = f"{header}.{count}"
+            count = counts.get(suffixed, 0)
+            counts[suffixed] = count + 1
+            header = suffixed
+        deduped.append(header)
+    return deduped
+
+# Built once and reused, so refreshes keep the authorized connection instead of
+# re-reading credentials and opening a new TLS session; only used under _cache_lock
+_service: Optional[GoogleSheetsService] = None
+
+def _get_service() -> GoogleSheetsService:
+    global _service
+    # Retry the build while credentials are missing or failed to load
+    if _service is None or _service.service is None:
+        _service = GoogleSheetsService()
+    return _service
+
+def _adopt_newer_snapshot() -> Optional[pd.DataFrame]:
+    """Load a snapshot another worker pulled within CACHE_TTL, if it is newer than the cache.
+
+    Call with _cache_lock held. The cache timestamp becomes the file's mtime, so
+    staleness still tracks the age of the data.
+    """
+    try:
+        mtime = os.path.getmtime(SNAPSHOT_PATH)
+    except OSError:
+        return None
+    if mtime <= _cache["timestamp"]:
+        return None
+    snapshot = _read_snapshot(max_age=CACHE_TTL)
+    if snapshot is None or snapshot.empty:
+        return None
+    _cache["df"] = snapshot
+    _cache["timestamp"] = mtime
+    return snapshot
+
+def _background_refresh() -> None:
+    try:
+        with _cache_lock:
+            if _adopt_newer_snapshot() is None:
+                _pull_seo_data()
+    finally:
+        _refresh_lock.release()
+
+def load_seo_data(force_refresh: bool = False) -> pd.DataFrame:
+    """Return the combined SEO crawl.
+
+    Once loaded, an expired copy is still returned immediately while a single
+    background thread re-pulls it. force_refresh reloads synchronously; either
+    way, a snapshot another worker pulled within CACHE_TTL is used instead of Sheets.
+    """
+    df = _cache["df"]
+    if not force_refresh and df is not None:
+        if time.time() - _cache["timestamp"] >= CACHE_TTL and _refresh_lock.acquire(blocking=False):
+            threading.Thread(target=_background_refresh, name="seo-sheets-refresh", daemon=True).start()
+        return df
+
+    with _cache_lock:
+        # Another thread may have loaded it while this one waited
+        if not force_refresh and _cache["df"] is not None:
+            return _cache["df"]
+
+        # Cold start takes any snapshot within SNAPSHOT_MAX_AGE; later loads only a newer one
+        if _cache["df"] is None:
+            try:
+                mtime = os.path.getmtime(SNAPSHOT_PATH)
+            except OSError:
+                mtime = None
+            snapshot = _read_snapshot() if mtime is not None else None
+            if snapshot is not None and not snapshot.empty:
+                _cache["df"] = snapshot
+                # Age the copy from when it was pulled, so an old snapshot refreshes soon
+                _cache["timestamp"] = mtime
+                return snapshot
+        else:
+            snapshot = _adopt_newer_snapshot()
+            if snapshot is not None:
+                return snapshot
+
+        return _pull_seo_data()
+
+def _pull_seo_data() -> pd.DataFrame:
+    """Fetch every tab from Sheets and update the cache; call with _cache_lock held."""
     try:
-        sheet_url = os.getenv("SEO_SHEET_URL", "https://docs.google.com/spreadsheets/d/1zzf4ax_H2WiTBVrJigGjF2Q3Yz-qy2qMCbAMKvl6VEE/edit")
-        service = GoogleSheetsService()
+        service = _get_service()
         
         # Returns { "Sheet1": [[...]], "Sheet2": [[...]] }
-        all_tabs_data = service.get_all_sheets_data(sheet_url)
+        all_tabs_data = service.get_all_sheets_data(SHEET_URL)
         
         if not all_tabs_data:
             logger.warning("⚠️ No data returned from Sheets Service.")
@@ -32,29 +179,43 @@ def load_seo_data() -> pd.DataFrame:
                 continue 
             
             # Headers (Row 1)
-            headers = [str(h).strip() for h in rows[0]]
+            headers = _dedupe_headers(np.char.strip(np.asarray(rows[0], dtype=str)).tolist())
             # Data (Row 2+)
             data = rows[1:]
             
             # Align columns
+            # Sheets drops trailing empty cells, so rows are ragged: scatter every
+            # cell into a blank grid in one masked assignment instead of padding rows
             max_cols = len(headers)
-            aligned_data = [r + [""] * (max_cols - len(r)) for r in data]
+            lengths = np.fromiter(map(len, data), dtype=np.intp, count=len(data))
+            filled = np.arange(max_cols) < np.minimum(lengths, max_cols)[:, None]
+            grid = np.full((len(data), max_cols), "", dtype=object)
+            grid[filled] = list(itertools.chain.from_iterable(r[:max_cols] for r in data))
             
             # Create DF
-            df = pd.DataFrame([r[:max_cols] for r in aligned_data], columns=headers)
+            df = pd.DataFrame(grid, columns=headers)
             df['Sheet_Source'] = sheet_name
             combined_dfs.append(df)
 
         if not combined_dfs:
             return pd.DataFrame()
 
-        master_df = pd.concat(combined_dfs, axis=0, ignore_index=True, sort=False)
+        # A single tab is already the whole frame; concatenating would only copy it
+        if len(combined_dfs) == 1:
+            master_df = combined_dfs[0]
+        else:
+            master_df = pd.concat(combined_dfs, axis=0, ignore_index=True, sort=False)
         
         # Clean empty cols
-        master_df.dropna(axis=1, how='all', inplace=True)
-        master_df.fillna("", inplace=True)
+        # Every column comes from a tab whose short rows were padded with "", so none
+        # is all-NaN; NaN only appears where tabs have different columns
+        first_columns = combined_dfs[0].columns
+        if any(not df.columns.equals(first_columns) for df in combined_dfs[1:]):
+            master_df.fillna("", inplace=True)
 
         _cache["df"] = master_df
+        _write_snapshot(master_df)
+        # Stamped after the write, so this worker never mistakes its own snapshot for a newer one
         _cache["timestamp"] = time.time()
         
         logger.info(f"✅ Loaded {len(master_df)} rows from {len(combined_dfs)} tabs.")